@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Hashable, Optional, Tuple
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - batched logging
+# off: every per-record event is its own INFO line, written as it happens
+# COA_LOG_BATCHED=true: log records go through a queue to a background
+# listener, per-record events go to a JSONL audit trail instead and are
+# summed up in a progress line every COA_PROGRESS_INTERVAL seconds
+# *********************************************************************
+
+BATCHED = os.environ.get("COA_LOG_BATCHED", "false").lower() == "true"
+
+# appended to, one compact JSON line per event
+AUDIT_PATH = os.environ.get("COA_AUDIT_PATH", "coa_audit.jsonl")
+
+PROGRESS_INTERVAL = float(os.environ.get("COA_PROGRESS_INTERVAL", 30))
+
+# events written with one write() call
+WRITE_BATCH = 1000
+
+_STOP = object()
+
+# *********************************************************************
+# CLASSES -
+# AuditTrail: background writer of the JSONL audit trail, also counts the
+# events into the periodic progress summaries
+# *********************************************************************
+
+
+class AuditTrail:
+    """Queues per-record events and writes them to a JSONL file on a background thread"""
+
+    def __init__(self, path: str = AUDIT_PATH, progress_interval: float = PROGRESS_INTERVAL):
+        self.path = path
+        self.progress_interval = progress_interval
+        self.queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+
+        # only touched by the writer thread
+        self.counts: Counter = Counter()
+        self.totals: Counter = Counter()
+
+        self.file = open(path, "a")
+        self.thread = threading.Thread(target=self.write_loop, name="coa-audit", daemon=True)
+        self.thread.start()
+
+    def record(self, event: str, scope: str, key: Hashable, **fields: Any):
+        self.queue.put((time.time(), event, scope, key, fields))
+
+    def write_loop(self):
+        next_summary = time.monotonic() + self.progress_interval
+        stopped = False
+
+        while not stopped:
+            try:
+                items = [self.queue.get(timeout=max(next_summary - time.monotonic(), 0))]
+            except queue.Empty:
+                items = []
+
+            # whatever else is queued already goes out with the same write
+            while items and len(items) < WRITE_BATCH:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if _STOP in items:
+                items.remove(_STOP)
+                stopped = True
+
+            if items:
+                self.write(items)
+
+            if stopped or time.monotonic() >= next_summary:
+                self.summarize()
+                next_summary = time.monotonic() + self.progress_interval
+
+        self.file.close()
+
+        log.info(f"Audit trail {self.path}: {self.format_counts(self.totals) or 'no events'}")
+
+    def write(self, items: list):
+        lines = []
+
+        for timestamp, event, scope, key, fields in items:
+            entry = {"time": datetime.utcfromtimestamp(timestamp).isoformat() + "Z", "event": event, "scope": scope, "key": list(key) if isinstance(key, tuple) else key}
+            entry.update(fields)
+
+            lines.append(json.dumps(entry, separators=(",", ":"), default=str))
+
+            self.counts[(scope, event)] += 1
+
+        self.file.write("\n".join(lines) + "\n")
+        self.file.flush()
+
+    @staticmethod
+    def format_counts(counts: Counter) -> str:
+        scopes: dict = {}
+
+        for (scope, event), count in sorted(counts.items()):
+            scopes.setdefault(scope, []).append(f"{count} {event}")
+
+        return "; ".join(f"{scope}: {', '.join(events)}" for scope, events in scopes.items())
+
+    def summarize(self):
+        if not self.counts:
+            return
+
+        log.info(f"Progress since the last summary, {self.format_counts(self.counts)}")
+
+        self.totals.update(self.counts)
+        self.counts.clear()
+
+    def close(self):
+        """Writes what is still queued, logs the totals and closes the file"""
+
+        self.queue.put(_STOP)
+        self.thread.join()
+
+
+# *********************************************************************
+# FUNCTIONS -
+# start / stop: switch the batched mode on for the run and flush it at the end
+# start_shard: the same in a forked shard worker, with its own audit trail
+# record: one per-record event, an INFO line or an audit trail entry
+# *********************************************************************
+
+# the root handlers start() moved behind the queue, stop() puts them back
+log_handlers: Tuple[logging.Handler, ...] = ()
+
+listener: Optional[QueueListener] = None
+trail: Optional[AuditTrail] = None
+
+
+def start(batched: bool = BATCHED, path: str = AUDIT_PATH):
+    """Moves the root handlers behind a queue and opens the audit trail, when batched"""
+
+    global log_handlers, listener, trail
+
+    if not batched or listener is not None:
+        return
+
+    root = logging.getLogger()
+    log_queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+
+    log_handlers = tuple(root.handlers)
+    root.handlers = [QueueHandler(log_queue)]
+
+    listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    listener.start()
+
+    trail = AuditTrail(path)
+
+
+def start_shard(name: str, batched: bool = BATCHED, path: str = AUDIT_PATH):
+    """start() in a shard worker, with an audit trail of the shard's own, e.g. coa_audit.entities.jsonl"""
+
+    root, extension = os.path.splitext(path)
+
+    start(batched, f"{root}.{name}{extension}")
+
+
+def stop():
+    """Flushes the audit trail and the queued log records, before the process exits"""
+
+    global listener, trail
+
+    if trail is not None:
+        trail.close()
+        trail = None
+
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+        # the next shard a worker runs starts again from the plain handlers
+        logging.getLogger().handlers = list(log_handlers)
+
+
+def record(logger: logging.Logger, event: str, scope: str, key: Hashable, message: str, **fields: Any):
+    """Logs message at INFO, or adds the event to the audit trail in batched mode
+
+    Args:
+        event (str): e.g. planned, created, saved, archived, failed
+        scope (str): the segment type
+        fields: extra audit trail fields, e.g. the operation or the error
+    """
+
+    if trail is None:
+        logger.info(message)
+    else:
+        trail.record(event, scope, key, **fields)
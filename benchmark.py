@@ -0,0 +1,420 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import resource
+import runpy
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - offline benchmark of main.py
+# the parent process serves a fake iPaaS (/api/jwt, /api/general_ledger)
+# and starts one child process per dataset size, which runs main.py
+# unchanged against a fake in-process planon module and reports its wall
+# time, peak memory and metrics run report
+# *********************************************************************
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+# ipaas.utils as main.py imports it, always this checkout's copy
+UTILS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils.py")
+
+# general_ledger segment: (code field, description field, Planon segment type), as in sync.SEGMENTS
+SEGMENT_FIELDS = {
+    "entities": ("entity", "entity_description", "SEG1"),
+    "orgs": ("org", "org_description", "SEG2"),
+    "fundings": ("funding", "funding_description", "SEG3"),
+    "activities": ("activity", "activity_description", "SEG4"),
+    "subactivities": ("subactivity", "subactivity_description", "SEG5"),
+    "natural_classes": ("natural_class", "natural_class_description", "SEG6"),
+}
+
+# *********************************************************************
+# FUNCTIONS -
+# dartmouth_dataset: the general_ledger records of one segment
+# planon_dataset: the billing accounts Planon holds before the run, a mix of
+# in-sync, renamed, removed (to archive) and archived (history) records
+# *********************************************************************
+
+
+def dartmouth_dataset(segment: str, count: int) -> List[Dict[str, Any]]:
+    code_field, description_field, _ = SEGMENT_FIELDS[segment]
+
+    # subactivity codes repeat across activities, they are only unique with their description
+    codes = max(count // 3, 1) if segment == "subactivities" else count
+
+    return [
+        {
+            code_field: f"{index % codes:07d}",
+            description_field: f"{segment} {index}",
+            "last_update_date": f"2024-01-01T00:00:{index % 60:02d}",
+        }
+        for index in range(count)
+    ]
+
+
+def planon_dataset(segment: str, count: int, seed: int, existing: float, renamed: float, removed: float, archived: float) -> List[Dict[str, Any]]:
+    code_field, description_field, segment_type = SEGMENT_FIELDS[segment]
+
+    rng = random.Random(f"{seed}-{segment}")
+
+    records = []
+
+    for record in dartmouth_dataset(segment, count):
+        if rng.random() >= existing:
+            continue
+
+        name = record[description_field] + (" (old)" if rng.random() < renamed else "")
+        records.append({"Code": record[code_field], "Name": name, "SegmentType": segment_type, "IsArchived": False})
+
+    for index in range(int(count * removed)):
+        records.append({"Code": f"R{index:07d}", "Name": f"{segment} removed {index}", "SegmentType": segment_type, "IsArchived": False})
+
+    for index in range(int(count * archived)):
+        records.append({"Code": f"A{index:07d}", "Name": f"{segment} archived {index}", "SegmentType": segment_type, "IsArchived": True})
+
+    return records
+
+
+# *********************************************************************
+# CLASSES -
+# FakeIpaasHandler / FakeIpaasServer: general_ledger pages with latency
+# and 429/5xx errors, optionally rejecting oversized pages
+# FakeBillingAccount / fake_planon_module: UsrBillingAccounts find,
+# create, save and execute with latency and errors, in memory
+# *********************************************************************
+
+
+class FakeIpaasHandler(BaseHTTPRequestHandler):
+    server: "FakeIpaasServer"
+
+    def log_message(self, format: str, *args):
+        log.debug(format % args)
+
+    def send_json(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None):
+        content = json.dumps(body).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(content)
+
+    def fail(self) -> bool:
+        """Sends a 429 or 503 error_rate of the time"""
+
+        if self.server.rng.random() >= self.server.error_rate:
+            return False
+
+        if self.server.rng.random() < 0.5:
+            self.send_json(429, {"error": "Too Many Requests"}, {"Retry-After": "0"})
+        else:
+            self.send_json(503, {"error": "Service Unavailable"})
+
+        return True
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+
+        if urlsplit(self.path).path != "/api/jwt":
+            return self.send_json(404, {"error": "Not Found"})
+
+        self.send_json(200, {"jwt": "benchmark", "payload": {"exp": time.time() + 3600}, "accepted_scopes": []})
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        path, query = urlsplit(self.path)[2:4]
+        params = dict(parse_qsl(query))
+
+        segment = path.rsplit("/", 1)[-1]
+
+        if not path.startswith("/api/general_ledger/") or segment not in self.server.datasets:
+            return self.send_json(404, {"error": "Not Found"})
+
+        if self.fail():
+            return
+
+        page_size = int(params.get("pagesize", 1000))
+        page = int(params.get("page", 1))
+
+        if self.server.max_page_size and page_size > self.server.max_page_size:
+            return self.send_json(400, {"error": f"pagesize can't be more than {self.server.max_page_size}"})
+
+        records = self.server.datasets[segment][(page - 1) * page_size : page * page_size]
+
+        self.send_json(200, records, {"x-request-id": f"benchmark-{segment}"})
+
+
+class FakeIpaasServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, records: int, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0, max_page_size: Optional[int] = None):
+        super().__init__(("127.0.0.1", 0), FakeIpaasHandler)
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_page_size = max_page_size
+        self.rng = random.Random(seed)
+
+        self.datasets = {segment: dartmouth_dataset(segment, records // len(SEGMENT_FIELDS)) for segment in SEGMENT_FIELDS}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-ipaas", daemon=True).start()
+
+
+class FakeBillingAccount:
+    def __init__(self, backend: "FakePlanon", Code: str, Name: str, SegmentType: str, IsArchived: bool = False):
+        self.backend = backend
+        self.Code = Code
+        self.Name = Name
+        self.SegmentType = SegmentType
+        self.IsArchived = IsArchived
+
+    def save(self) -> "FakeBillingAccount":
+        self.backend.call()
+        return self
+
+    def execute(self, bom: str) -> "FakeBillingAccount":
+        self.backend.call()
+        self.IsArchived = bom == "BomArchive"
+        return self
+
+
+class FakePlanon:
+    """In-memory UsrBillingAccounts with a per-call latency and a per-write error rate"""
+
+    def __init__(self, records: List[Dict[str, Any]], latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+        self.records = [FakeBillingAccount(self, **record) for record in records]
+
+    def call(self, write: bool = True):
+        time.sleep(self.latency)
+
+        with self.lock:
+            self.calls += 1
+            error = write and self.rng.random() < self.error_rate
+
+        if error:
+            # an overload error, so it counts against the adaptive concurrency and the circuit breaker
+            response = requests.Response()
+            response.status_code = 503
+
+            raise requests.HTTPError("Planon returned 503", response=response)
+
+    def find(self, segments_filter: Dict[str, Any]) -> List[FakeBillingAccount]:
+        # a failed read aborts main.py, errors are only injected into the writes
+        self.call(write=False)
+
+        conditions = segments_filter["filter"]
+        segment_type = conditions["FreeString11"]["eq"]
+        is_archived = conditions.get("IsArchived", {}).get("eq")
+
+        return [record for record in self.records if record.SegmentType == segment_type and (is_archived is None or record.IsArchived == is_archived)]
+
+    def create(self, values: Dict[str, Any]) -> FakeBillingAccount:
+        self.call()
+
+        record = FakeBillingAccount(self, Code=values["Code"], Name=values["Name"], SegmentType=values["FreeString11"])
+
+        with self.lock:
+            self.records.append(record)
+
+        return record
+
+
+def fake_planon_module(backend: FakePlanon) -> types.ModuleType:
+    """Returns a stand-in for the libplanon-rest planon module, backed by backend"""
+
+    module = types.ModuleType("planon")
+
+    module.PlanonResource = types.SimpleNamespace(set_site=lambda site: None, set_header=lambda jwt: None)
+    module.UsrBillingAccounts = types.SimpleNamespace(find=backend.find, create=backend.create)
+
+    return module
+
+
+def repo_ipaas_module() -> types.ModuleType:
+    """Returns an ipaas package whose utils is this checkout's utils.py, whatever ipaas is installed"""
+
+    package = types.ModuleType("ipaas")
+    package.__path__ = []
+
+    spec = importlib.util.spec_from_file_location("ipaas.utils", UTILS_PATH)
+    package.utils = importlib.util.module_from_spec(spec)
+
+    sys.modules["ipaas"] = package
+    sys.modules["ipaas.utils"] = package.utils
+
+    spec.loader.exec_module(package.utils)
+
+    return package
+
+
+# *********************************************************************
+# BENCHMARK
+# run_child: one main.py run in this process, called in the child
+# run: one child per dataset size, against a fresh fake iPaaS
+# *********************************************************************
+
+
+def run_child(args: argparse.Namespace):
+    planon_records = [record for segment in SEGMENT_FIELDS for record in planon_dataset(segment, args.records // len(SEGMENT_FIELDS), args.seed, args.existing, args.renamed, args.removed, args.archived)]
+
+    backend = FakePlanon(planon_records, latency=args.planon_latency, error_rate=args.planon_error_rate, seed=args.seed)
+
+    del planon_records
+
+    sys.modules["planon"] = fake_planon_module(backend)
+
+    # reads the DARTMOUTH_* settings of the fake iPaaS when it is loaded
+    repo_ipaas_module()
+    sys.argv = [MAIN_PATH] + shlex.split(args.main_args)
+
+    start = time.perf_counter()
+
+    try:
+        runpy.run_path(MAIN_PATH, run_name="__main__")
+    except SystemExit as e:
+        # the sharded runner exits once it is done
+        if e.code:
+            raise
+
+    seconds = time.perf_counter() - start
+
+    with open(os.environ["COA_METRICS_REPORT"], "r") as report_file:
+        report = json.load(report_file)
+
+    result = {
+        "records": args.records,
+        "seconds": round(seconds, 3),
+        # kilobytes on Linux, the largest of this process and any shard worker it forked
+        "max_rss_kb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+        # from the run report, shard workers call their own copy of the backend
+        "planon_calls": sum(entry["calls"] for entry in report["phases"] if entry["phase"].startswith("planon_") and entry["phase"] != "planon_fetch"),
+        "report": report,
+    }
+
+    with open(args.result, "w") as result_file:
+        json.dump(result, result_file)
+
+
+def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+
+    for records in args.records:
+        server = FakeIpaasServer(records, latency=args.ipaas_latency, error_rate=args.ipaas_error_rate, seed=args.seed, max_page_size=args.ipaas_max_page_size)
+        server.start()
+
+        with tempfile.TemporaryDirectory(prefix="coa-benchmark-") as directory:
+            result_path = os.path.join(directory, "result.json")
+
+            # anything else set (COA_ASYNC, COA_PREFETCH, PLANON_MAX_WORKERS, ...) is passed on, so variants can be compared
+            env = dict(
+                os.environ,
+                DARTMOUTH_API_URL=server.url,
+                DARTMOUTH_API_KEY="benchmark",
+                PLANON_API_URL="http://planon.invalid",
+                PLANON_API_KEY="benchmark",
+                COA_METRICS_REPORT=os.path.join(directory, "report.json"),
+                COA_JOURNAL_PATH=os.path.join(directory, "journal.jsonl"),
+                COA_SNAPSHOT_PATH=os.path.join(directory, "snapshot.sqlite3"),
+                COA_PAGE_SIZE_STATE=os.path.join(directory, "page_sizes.json"),
+                LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+            )
+
+            command = [sys.executable, os.path.abspath(__file__), "--child", "--result", result_path, "--records", str(records)]
+            command += ["--seed", str(args.seed), "--existing", str(args.existing), "--renamed", str(args.renamed), "--removed", str(args.removed), "--archived", str(args.archived)]
+            # --main-args=... so a value starting with "--" isn't taken for an option of the child
+            command += ["--planon-latency", str(args.planon_latency), "--planon-error-rate", str(args.planon_error_rate), f"--main-args={args.main_args}"]
+
+            log.info(f"Running main.py against {records} records")
+
+            subprocess.run(command, env=env, check=True)
+
+            with open(result_path, "r") as result_file:
+                result = json.load(result_file)
+
+        server.shutdown()
+        server.server_close()
+
+        log.info(f"{records} records: {result['seconds']}s, {result['max_rss_kb'] / 1024:.1f} MiB peak, {result['planon_calls']} Planon calls")
+
+        results.append(result)
+
+    return results
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark main.py offline, against a fake iPaaS server and a fake Planon backend")
+    parser.add_argument("--records", type=int, nargs="+", default=[1000, 10000, 100000], help="general_ledger records across the six segments, one run per size (up to 1000000)")
+    parser.add_argument("--ipaas-latency", type=float, default=0.0, help="seconds added to every iPaaS request")
+    parser.add_argument("--ipaas-error-rate", type=float, default=0.0, help="share of general_ledger requests answered with 429 or 503")
+    parser.add_argument("--ipaas-max-page-size", type=int, metavar="N", help="answer general_ledger requests with a pagesize above N with a 400, like the real API")
+    parser.add_argument("--planon-latency", type=float, default=0.0, help="seconds added to every Planon call")
+    parser.add_argument("--planon-error-rate", type=float, default=0.0, help="share of Planon writes that raise")
+    parser.add_argument("--existing", type=float, default=0.95, help="share of the Dartmouth records already in Planon")
+    parser.add_argument("--renamed", type=float, default=0.01, help="share of the existing records with an outdated name")
+    parser.add_argument("--removed", type=float, default=0.01, help="active Planon-only records to archive, as a share of the records")
+    parser.add_argument("--archived", type=float, default=0.5, help="archived Planon history, as a share of the records")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--main-args", default="", help='arguments for main.py, e.g. "--processes 6"')
+    parser.add_argument("--output", help="write the results, with each run's metrics report, to this JSON file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.child:
+        args.records = args.records[0]
+        run_child(args)
+        sys.exit(0)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    results = run(args)
+
+    print(f"{'records':>10} {'seconds':>10} {'MiB peak':>10} {'Planon calls':>13}")
+
+    for result in results:
+        print(f"{result['records']:>10} {result['seconds']:>10} {result['max_rss_kb'] / 1024:>10.1f} {result['planon_calls']:>13}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
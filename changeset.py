@@ -0,0 +1,56 @@
+import json
+import logging
+from typing import Iterable, Iterator
+
+from sync import Change
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# FUNCTIONS -
+# write_changeset: planned Changes as JSON lines, one per mutation
+# read_changeset: the Changes back from such a file
+# *********************************************************************
+
+
+def write_changeset(changes: Iterable[Change], path: str) -> int:
+    """Writes the changes to path as JSON lines
+
+    Returns:
+        _type_: int, the number of changes written
+    """
+
+    count = 0
+
+    with open(path, "w") as changeset_file:
+        for change in changes:
+            entry = change._asdict()
+            entry["key"] = list(change.key) if isinstance(change.key, tuple) else change.key
+
+            changeset_file.write(json.dumps(entry) + "\n")
+            count += 1
+
+    log.info(f"Wrote {count} changes to {path}")
+
+    return count
+
+
+def read_changeset(path: str) -> Iterator[Change]:
+    """Yields the changes of a changeset written by write_changeset"""
+
+    with open(path, "r") as changeset_file:
+        for line in changeset_file:
+            if not line.strip():
+                continue
+
+            entry = json.loads(line)
+
+            # composite keys were written as lists
+            if isinstance(entry["key"], list):
+                entry["key"] = tuple(entry["key"])
+
+            yield Change(**entry)
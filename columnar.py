@@ -0,0 +1,136 @@
+import logging
+import os
+from typing import Any, Dict, Hashable, List, Tuple
+
+from planon_utils import ARCHIVE, CREATE, REACTIVATE, SAVE
+
+# optional, imported on the first columnar reconcile only (see load), SegmentSync falls back to the per-record diff without them
+numpy: Any = None
+pandas: Any = None
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - columnar reconciliation of one segment
+# python: per-record set and dict diff in SegmentSync
+# columnar: both sides as NumPy columns, aligned on a pandas hash index
+# auto: columnar once a segment has COA_COLUMNAR_MIN_ROWS rows and pandas is installed
+# *********************************************************************
+
+DIFF_ENGINE = os.environ.get("COA_DIFF_ENGINE", "auto")
+COLUMNAR_MIN_ROWS = int(os.environ.get("COA_COLUMNAR_MIN_ROWS", 50000))
+
+# *********************************************************************
+# FUNCTIONS -
+# load: import pandas and NumPy, only once a segment is reconciled here
+# use_columnar: whether a segment of `rows` rows is reconciled here
+# reconcile: inserts, updates, archives and reactivations of a segment
+# from its Dartmouth and Planon columns, aligned on the dict keys
+# *********************************************************************
+
+
+def load() -> bool:
+    """Imports pandas and NumPy, a run whose segments all stay below COLUMNAR_MIN_ROWS never pays for them
+
+    Returns:
+        _type_: bool, whether both are installed
+    """
+
+    global numpy, pandas
+
+    if pandas is None:
+        try:
+            import numpy as numpy_module
+            import pandas as pandas_module
+        except ImportError:
+            return False
+
+        numpy, pandas = numpy_module, pandas_module
+
+    return True
+
+
+def use_columnar(rows: int, engine: str = DIFF_ENGINE) -> bool:
+    if engine == "python" or (engine != "columnar" and rows < COLUMNAR_MIN_ROWS):
+        return False
+
+    if not load():
+        if engine == "columnar":
+            raise Exception("pandas is required for COA_DIFF_ENGINE=columnar")
+
+        return False
+
+    return True
+
+
+def reconcile(segment: Any, dartmouth: Dict[Hashable, Any], planon: Dict[Hashable, Any]) -> Dict[str, List[Tuple[Hashable, str, str]]]:
+    """Returns the planned mutations of a segment, keyed by operation
+
+    The Planon keys are hashed once into a pandas Index and every Dartmouth
+    key is looked up in it in one call (an outer join on the key). Every field
+    the segment maps into Planon is then compared column by column, not only
+    the name.
+
+    Args:
+        segment (sync.Segment): the segment both dicts belong to
+        dartmouth (dict): COARecords keyed by segment.dartmouth_key
+        planon (dict): UsrBillingAccounts keyed by segment.planon_key
+    Returns:
+        _type_: dict[operation, list[(key, code, name)]], operations as in sync.SegmentSync
+    """
+
+    if not load():
+        raise Exception("pandas is required for the columnar reconciliation")
+
+    # object indexes keep composite keys as plain tuples, a MultiIndex is much slower to build
+    dartmouth_keys = pandas.Index(list(dartmouth), dtype=object, tupleize_cols=False)
+    planon_keys = pandas.Index(list(planon), dtype=object, tupleize_cols=False)
+
+    dartmouth_columns = {field: numpy.asarray(column, dtype=object) for field, column in segment.columns(dartmouth.values()).items()}
+    planon_columns = {field: numpy.asarray(column, dtype=object) for field, column in segment.planon_columns(planon.values()).items()}
+
+    planon_active = numpy.fromiter((record.IsArchived == False for record in planon.values()), dtype=bool, count=len(planon))
+
+    # position of every Dartmouth key among the Planon keys, -1 when Planon doesn't have it
+    positions = planon_keys.get_indexer(dartmouth_keys)
+
+    matched = positions >= 0
+    matched_positions = positions[matched]
+
+    active = numpy.zeros(len(dartmouth), dtype=bool)
+    active[matched] = planon_active[matched_positions]
+
+    changed = numpy.zeros(len(dartmouth), dtype=bool)
+
+    for field in segment.fields:
+        changed[matched] |= dartmouth_columns[field][matched] != planon_columns[field][matched_positions]
+
+    in_dartmouth = numpy.zeros(len(planon), dtype=bool)
+    in_dartmouth[matched_positions] = True
+
+    def dartmouth_rows(mask: "numpy.ndarray") -> List[Tuple[Hashable, str, str]]:
+        selected = numpy.flatnonzero(mask)
+
+        # a matched key carries the code, so the Dartmouth and Planon codes are the same
+        return list(zip(dartmouth_keys[selected], dartmouth_columns["Code"][selected], dartmouth_columns["Name"][selected]))
+
+    def planon_rows(mask: "numpy.ndarray") -> List[Tuple[Hashable, str, str]]:
+        selected = numpy.flatnonzero(mask)
+
+        return list(zip(planon_keys[selected], planon_columns["Code"][selected], planon_columns["Name"][selected]))
+
+    planned = {
+        CREATE: dartmouth_rows(~matched),
+        # a composite key contains the description, so a rename shows up as a create plus an archive
+        SAVE: [] if segment.composite_key else dartmouth_rows(matched & active & changed),
+        ARCHIVE: planon_rows(~in_dartmouth & planon_active),
+        REACTIVATE: dartmouth_rows(matched & ~active),
+    }
+
+    log.debug(f"Reconciled {len(dartmouth)} Dartmouth and {len(planon)} Planon {segment.label} columnar")
+
+    return planned
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import threading
+from typing import Hashable, Optional, Set, Tuple
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - write-ahead journal of Planon mutations
+# one JSON line per planned, done or failed create/save/archive
+# *********************************************************************
+
+JOURNAL_PATH = os.environ.get("COA_JOURNAL_PATH", "coa_journal.jsonl")
+
+PLANNED = "planned"
+DONE = "done"
+FAILED = "failed"
+
+# written when a run gets to its end, the entries before it are no longer resumed
+FINISHED = "finished"
+
+# *********************************************************************
+# CLASSES -
+# Journal: append the state of every mutation, and on resume tell which
+# ones already made it into Planon
+# *********************************************************************
+
+
+class Journal:
+    """Write-ahead journal of Planon mutations, so a run can be resumed
+
+    A fresh run starts an empty journal; a resumed run appends to it and
+    skips every operation the journal records as done, with the same code
+    and name. A run that got to its end is marked finished, so resuming
+    after it skips nothing.
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH, resume: bool = False):
+        self.path = path
+        self.done: Set[Tuple[str, str, str, Optional[str], Optional[str]]] = set()
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            with open(path, "r") as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a run that died mid-write
+                        continue
+
+                    if entry["state"] == FINISHED:
+                        self.done.clear()
+
+                    elif entry["state"] == DONE:
+                        self.done.add((entry["operation"], entry["scope"], json.dumps(entry["key"]), entry.get("code"), entry.get("name")))
+
+            log.info(f"Resuming with {len(self.done)} completed operations from {path}")
+
+        self.file = open(path, "a" if resume else "w")
+
+    @staticmethod
+    def encode_key(key: Hashable) -> str:
+        return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+    def is_done(self, operation: str, scope: str, key: Hashable, code: Optional[str] = None, name: Optional[str] = None) -> bool:
+        """Whether the resumed run wrote exactly this change, a different name is still sent"""
+
+        return (operation, scope, self.encode_key(key), code, name) in self.done
+
+    def write(self, state: str, operation: str, scope: str, key: Hashable, code: Optional[str] = None, name: Optional[str] = None):
+        line = json.dumps({"state": state, "operation": operation, "scope": scope, "key": list(key) if isinstance(key, tuple) else key, "code": code, "name": name})
+
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def planned(self, operation: str, scope: str, key: Hashable, code: Optional[str] = None, name: Optional[str] = None):
+        self.write(PLANNED, operation, scope, key, code, name)
+
+    def completed(self, operation: str, scope: str, key: Hashable, code: Optional[str] = None, name: Optional[str] = None):
+        self.write(DONE, operation, scope, key, code, name)
+
+    def failed(self, operation: str, scope: str, key: Hashable, code: Optional[str] = None, name: Optional[str] = None):
+        self.write(FAILED, operation, scope, key, code, name)
+
+    def finish(self):
+        """Marks the run as finished, a later --resume starts from a clean slate"""
+
+        with self.lock:
+            self.file.write(json.dumps({"state": FINISHED}) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -1,12 +1,25 @@
+import argparse
+import asyncio
+import atexit
 import logging
 import os
 import sys
 import time
 from datetime import datetime
+from itertools import chain
 
 import planon
 import ipaas.utils
 
+import audit
+import planon_utils
+from changeset import read_changeset, write_changeset
+from journal import Journal
+from metrics import metrics
+from shards import get_shards, run_sharded
+from snapshot import Snapshot
+from sync import SEGMENTS, SegmentSync, partition_planon_segments
+
 # *********************************************************************
 # SETUP
 # *********************************************************************
@@ -25,6 +38,29 @@ logging.Formatter.default_msec_format = "%s.%03d"
 
 log = logging.getLogger(__name__)
 
+parser = argparse.ArgumentParser(description="Feed the chart of accounts segments from the GL (iPaaS) into Planon")
+parser.add_argument("--resume", action="store_true", help="skip the Planon writes the journal of the previous run has as done")
+parser.add_argument("--plan", metavar="CHANGESET", help="write the inserts, updates, archives and reactivations to CHANGESET (JSON lines) instead of sending them to Planon")
+parser.add_argument("--apply", metavar="CHANGESET", help="send a CHANGESET written by --plan to Planon, without reading Dartmouth")
+parser.add_argument("--processes", type=int, metavar="N", help="full sync with every segment type in its own worker process, N at a time")
+args = parser.parse_args()
+
+if args.plan and args.apply:
+    parser.error("--plan and --apply can't be combined")
+
+# Incremental runs only send keys that changed in Dartmouth since the last run, see snapshot.Snapshot
+incremental = os.environ.get("COA_INCREMENTAL", "false").lower() == "true"
+
+# Delta runs only pull records updated since the last successful run, see ipaas.utils.iter_coa_segment
+# removals can't be seen in a delta, so nothing is archived, schedule a full run for that
+delta = os.environ.get("COA_DELTA", "false").lower() == "true"
+
+# Async runs page every segment on one event loop (aiohttp) instead of a thread pool, see ipaas.utils.async_get_coa_segments
+use_async = os.environ.get("COA_ASYNC", "false").lower() == "true"
+
+if args.processes and (args.plan or args.apply or incremental or delta):
+    parser.error("--processes runs a full sync, it can't be combined with --plan, --apply, COA_INCREMENTAL or COA_DELTA")
+
 # *********************
 # PLANON
 # *********************
@@ -38,511 +74,195 @@ planon.PlanonResource.set_header(jwt=os.environ["PLANON_API_KEY"])
 
 start = datetime.utcnow()
 
+# Every general_ledger page, Planon call and sync phase is timed into one run report, see metrics.Metrics
+ipaas.utils.request_hooks.append(metrics.observe_dartmouth_request)
+
 # ********************************************************************
-# Source DARTMOUTH Billing accounts
-# Loop through all chart of accounts based on the segment type in iPaas
+# SHARDED
+# Each shard reads, diffs and writes its own segment in a worker process,
+# the results and metrics are merged here, see shards.run_sharded
 # *********************************************************************
 
-log.info("Getting chart of accounts segments from Dartmouth")
-
-dartmouth_entities = {entity["entity"]: entity for entity in ipaas.utils.get_coa_segment(segment="entities")}
-dartmouth_orgs = {org["org"]: org for org in ipaas.utils.get_coa_segment(segment="orgs")}
-dartmouth_fundings = {funding["funding"]: funding for funding in ipaas.utils.get_coa_segment(segment="fundings")}
-dartmouth_activities = {activity["activity"]: activity for activity in ipaas.utils.get_coa_segment(segment="activities")}
-dartmouth_subactivities = {
-    (subactivity["subactivity"], subactivity["subactivity_description"]): subactivity for subactivity in ipaas.utils.get_coa_segment(segment="subactivities")
-}
-dartmouth_natural_classes = {natural_class["natural_class"]: natural_class for natural_class in ipaas.utils.get_coa_segment(segment="natural_classes")}
-
-# ***********************************************************************
-# Source PLANON Billing accounts
-# Loop through all chart of accounts in Planon
-# ***********************************************************************
-
-log.info("Getting chart of accounts segments from Planon")
-
-segments_filter = {
-    "filter": {
-        "FreeString11": {"exists": True},  # Segment type
-    }
-}
-
-planon_coa_segments = planon.UsrBillingAccounts.find(segments_filter)
-
-planon_entities = {entity.Code: entity for entity in planon_coa_segments if entity.SegmentType == "SEG1"}
-planon_orgs = {org.Code: org for org in planon_coa_segments if org.SegmentType == "SEG2"}
-planon_fundings = {funding.Code: funding for funding in planon_coa_segments if funding.SegmentType == "SEG3"}
-planon_activities = {activity.Code: activity for activity in planon_coa_segments if activity.SegmentType == "SEG4"}
-planon_subactivities = {(subactivity.Code, subactivity.Name): subactivity for subactivity in planon_coa_segments if subactivity.SegmentType == "SEG5"}
-planon_natural_classes = {natural_class.Code: natural_class for natural_class in planon_coa_segments if natural_class.SegmentType == "SEG6"}
-
-log.info(
-    f"From Dartmouth retrieved {len(dartmouth_entities)} entities, {len(dartmouth_orgs)} orgs, {len(dartmouth_fundings)} fundings, {len(dartmouth_activities)} activities, {len(dartmouth_subactivities)} subactivities, {len(dartmouth_natural_classes)} natural classes"
-)
-
-log.info(
-    f"From Planon retrieved {len(planon_entities)} entities, {len(planon_orgs)} orgs, {len(planon_fundings)} fundings, {len(planon_activities)} activities, {len(planon_subactivities)} subactivities, {len(planon_natural_classes)} natural classes"
-)
-
-succeeded = []
-failed = []
-archived = []
-
-# *********************
-# ENTITIES
-# *********************
-
-log.info("# **************** Processing COA entities **************** #")
-
-# ********************* INSERTS ********************* #
-
-# Inserts new entity in Planon, if it doesn't exist
-inserts = set(dartmouth_entities) - set(planon_entities)
-log.info(f"Total number of entities to be inserted in Planon {len(inserts)}")
-
-for insert in inserts:
-    log.info(f"Processing insert {insert}")
-
-    try:
-        dartmouth_entity = dartmouth_entities[insert]  # dict comprehension to match both sides
-
-        planon_entity = planon.UsrBillingAccounts.create(
-            values={
-                "Code": dartmouth_entity["entity"],
-                "Name": dartmouth_entity["entity_description"],
-                "FreeString11": "SEG1",  # Segment type
-            }
-        )
-
-        log.info(f"Successfully added {insert}")
-        succeeded.append(insert)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(insert)
-
-# ********************* UPDATES ********************* #
-
-# Updates name in Planon side, if there is a change:
-updates = set(dartmouth_entities).intersection(set(planon_entities))
-log.info(f"Total number of entities to be updated in Planon {len(updates)}")
-
-for update in updates:
-    try:
-        dartmouth_entity = dartmouth_entities[update]
-        planon_entity = planon_entities[update]
-
-        if dartmouth_entity["entity_description"] != planon_entity.Name:
-            log.info(f"Processing update {update}")
-            planon_entity.Name = dartmouth_entity["entity_description"]
-            planon_entity = planon_entity.save()
-
-            log.info(f"Successfully updated {planon_entity.Name} with {planon_entity.Code} ")
-            succeeded.append(planon_entity)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(update)
-
-# ********************* ARCHIVES ********************* #
-
-# TODO - Do we need to archive entities that are not in Dartmouth anymore?
-# Archives entities in Planon, if it doesn't exist in Dartmouth
-archives = set(planon_entities) - set(dartmouth_entities)
-log.info(f"Total number of subactivities to be archived in Planon {len(archives)}")
-
-for archive in archives:
-    log.info(f"Processing archive {archive}")
-
-    try:
-        planon_entity = planon_entities[archive]
-
-        if planon_entity.IsArchived == False:
-            log.info(f"Archiving {planon_entity.Name} with {planon_entity.Code} ")
-            planon_entity.execute(bom="BomArchive")
-
-            log.info(f"Successfully archived {planon_entity.Name} with {planon_entity.Code} ")
-            archived.append(planon_entity)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(archive)
-
-# *********************
-# ORGS
-# *********************
-
-log.info("# **************** Processing COA orgs **************** #")
-
-# ********************* INSERTS ********************* #
-
-# Inserts new org in Planon, if it doesn't exist
-inserts = set(dartmouth_orgs) - set(planon_orgs)
-log.info(f"Total number of orgs to be inserted in Planon {len(inserts)}")
-
-for insert in inserts:
-    log.info(f"Processing insert {insert}")
-
-    try:
-        dartmouth_org = dartmouth_orgs[insert]  # dict comprehension to match both sides
-
-        planon_org = planon.UsrBillingAccounts.create(
-            values={
-                "Code": dartmouth_org["org"],
-                "Name": dartmouth_org["org_description"],
-                "FreeString11": "SEG2",  # Segment type
-            }
-        )
-
-        log.info(f"Successfully added {insert}")
-        succeeded.append(insert)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(insert)
-
-# ********************* UPDATES ********************* #
-
-# Updates
-updates = set(dartmouth_orgs).intersection(set(planon_orgs))
-log.info(f"Total number of orgs to be updated in Planon {len(updates)}")
-
-for update in updates:
-    try:
-        dartmouth_org = dartmouth_orgs[update]
-        planon_org = planon_orgs[update]
+if args.processes:
+    shards = get_shards()
 
-        if dartmouth_org["org_description"] != planon_org.Name:
-            log.info(f"Processing update {update}")
-            planon_org.Name = dartmouth_org["org_description"]
-            planon_org = planon_org.save()
+    log.info(f"Running {len(shards)} shards on {args.processes} processes")
 
-            log.info(f"Successfully updated {planon_org.Name} with {planon_org.Code} ")
-            succeeded.append(planon_org)
+    succeeded, failed, archived, deferred, failed_shards = run_sharded(shards, processes=args.processes, resume=args.resume)
 
-    except Exception as e:
-        log.exception(e)
-        failed.append(update)
+    log.info(f"Finished in {datetime.utcnow() - start}: {len(succeeded)} succeeded, {len(failed)} failed, {len(archived)} archived, {len(deferred)} deferred")
 
-# ********************* ARCHIVES ********************* #
+    metrics.write()
 
-# TODO - Do we need to archive orgs that are not in Dartmouth anymore?
-# Archives orgs in Planon, if it doesn't exist in Dartmouth
-archives = set(planon_orgs) - set(dartmouth_orgs)
-log.info(f"Total number of orgs to be archived in Planon {len(archives)}")
+    if failed_shards:
+        # their writes are journalled, rerun with --resume
+        log.error(f"Shards {', '.join(sorted(failed_shards))} failed")
+        sys.exit(1)
 
-for archive in archives:
-    log.info(f"Processing archive {archive}")
+    sys.exit(0)
 
-    try:
-        planon_org = planon_orgs[archive]
+# COA_LOG_BATCHED=true: log records are written by a background thread, the
+# per-record events go to the audit trail (COA_AUDIT_PATH), see audit.py;
+# started after the sharded branch, so no thread is running when it forks
+# (every shard worker starts its own, see shards.run_shard); stopped at exit,
+# so a run that raises still writes what is queued
+audit.start()
+atexit.register(audit.stop)
 
-        if planon_org.IsArchived == False:
-            log.info(f"Archiving {planon_org.Name} with {planon_org.Code} ")
-            planon_org.execute(bom="BomArchive")
-
-            log.info(f"Successfully archived {planon_org.Name} with {planon_org.Code} ")
-            archived.append(planon_org)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(archive)
-
-# *********************
-# FUNDINGS
-# *********************
-
-log.info("# **************** Processing COA fundings **************** #")
-
-# ********************* INSERTS ********************* #
-
-# Inserts:
-inserts = set(dartmouth_fundings) - set(planon_fundings)
-log.info(f"Total number of fundings to be inserted in Planon {len(inserts)}")
-
-for insert in inserts:
-    log.info(f"Processing insert {insert}")
-
-    try:
-        dartmouth_funding = dartmouth_fundings[insert]
-
-        planon_funding = planon.UsrBillingAccounts.create(
-            values={
-                "Code": dartmouth_funding["funding"],
-                "Name": dartmouth_funding["funding_description"],
-                "FreeString11": "SEG3",  # Segment type
-            }
-        )
-
-        log.info(f"Successfully added {insert}")
-        succeeded.append(insert)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(insert)
-
-# ********************* UPDATES ********************* #
-
-# Updates:
-updates = set(dartmouth_fundings).intersection(set(planon_fundings))
-log.info(f"Total number of fundings to be updated in Planon {len(updates)}")
-
-for update in updates:
-    try:
-        dartmouth_funding = dartmouth_fundings[update]
-        planon_funding = planon_fundings[update]
-
-        if dartmouth_funding["funding_description"] != planon_funding.Name:
-            log.info(f"Processing update {update}")
-            planon_funding.Name = dartmouth_funding["funding_description"]
-            planon_funding = planon_funding.save()
-
-            log.info(f"Successfully updated {planon_funding.Name} with {planon_funding.Code} ")
-            succeeded.append(planon_funding)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(update)
-
-# ********************* ARCHIVES ********************* #
-
-# TODO - Do we need to archive fundings that are not in Dartmouth anymore?
-# Archives orgs in Planon, if it doesn't exist in Dartmouth
-archives = set(planon_fundings) - set(dartmouth_fundings)
-log.info(f"Total number of fundings to be archived in Planon {len(archives)}")
-
-for archive in archives:
-    log.info(f"Processing archive {archive}")
-
-    try:
-        planon_funding = planon_fundings[archive]
-
-        if planon_funding.IsArchived == False:
-            log.info(f"Archiving {planon_funding.Name} with {planon_funding.Code} ")
-            planon_funding.execute(bom="BomArchive")
-
-            log.info(f"Successfully archived {planon_funding.Name} with {planon_funding.Code} ")
-            archived.append(planon_funding)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(archive)
-
-# *********************
-# ACTIVITIES
-# *********************
-
-log.info("# **************** Processing COA activities **************** #")
-
-# ********************* INSERTS ********************* #
-
-# Inserts:
-inserts = set(dartmouth_activities) - set(planon_activities)
-log.info(f"Total number of activities to be inserted in Planon {len(inserts)}")
-
-for insert in inserts:
-    log.info(f"Processing insert {insert}")
-
-    try:
-        dartmouth_activity = dartmouth_activities[insert]
-
-        planon_activity = planon.UsrBillingAccounts.create(
-            values={"Code": dartmouth_activity["activity"], "Name": dartmouth_activity["activity_description"], "FreeString11": "SEG4"}  # Segment type
-        )
-
-        log.info(f"Successfully added {insert}")
-        succeeded.append(insert)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(insert)
-
-# ********************* UPDATES ********************* #
-
-# Updates:
-updates = set(dartmouth_activities).intersection(set(planon_activities))
-log.info(f"Total number of activities to be updated in Planon {len(updates)}")
-
-for update in updates:
-    try:
-        dartmouth_activity = dartmouth_activities[update]
-        planon_activity = planon_activities[update]
-
-        if dartmouth_activity["activity_description"] != planon_activity.Name:
-            log.info(f"Processing update {update}")
-            planon_activity.Name = dartmouth_activity["activity_description"]
-            planon_activity = planon_activity.save()
-
-            log.info(f"Successfully updated {planon_activity.Name} with {planon_activity.Code} ")
-            succeeded.append(planon_activity)
-
-    except Exception as e:
-        log.exception(e)
-        failed.append(update)
-
-# ********************* ARCHIVES ********************* #
-
-# TODO - Do we need to archive activities that are not in Dartmouth anymore?
-# Archives orgs in Planon, if it doesn't exist in Dartmouth
-archives = set(planon_activities) - set(dartmouth_activities)
-log.info(f"Total number of activities to be archived in Planon {len(archives)}")
-
-for archive in archives:
-    log.info(f"Processing archive {archive}")
+# ********************************************************************
+# Source DARTMOUTH Billing accounts
+# Loop through all chart of accounts based on the segment type in iPaas
+# *********************************************************************
 
-    try:
-        planon_activity = planon_activities[archive]
+# The snapshot holds the incremental hashes and the delta watermarks, an applied changeset has no Dartmouth state
+snapshot = Snapshot() if (incremental or delta) and not args.apply else None
 
-        if planon_activity.IsArchived == False:
-            log.info(f"Archiving {planon_activity.Name} with {planon_activity.Code} ")
-            planon_activity.execute(bom="BomArchive")
+changed_since = {segment.name: snapshot.get_watermark(segment) for segment in SEGMENTS} if snapshot is not None and delta else None
 
-            log.info(f"Successfully archived {planon_activity.Name} with {planon_activity.Code} ")
-            archived.append(planon_activity)
+if args.apply:
+    log.info(f"Applying changeset {args.apply}, not reading Dartmouth")
 
-    except Exception as e:
-        log.exception(e)
-        failed.append(archive)
+    dartmouth_coa_segments = {segment.name: {} for segment in SEGMENTS}
 
-# *********************
-# SUBACTIVITIES
-# *********************
+else:
+    log.info("Getting chart of accounts segments from Dartmouth")
 
-# Subactivities are handled differently than the other segments because they are not a 1:1 mapping between Dartmouth and Planon. 
-# Unlike the other segments the subactivity is a child of the activity and the codes are not unique. 
-# The subactivity is unique within a given activity.
-# We do not want to show multiple subactivities of the same code in the UI, instead we will ensure that there is at least one subactivity for a given code + description.
-# If a code + description is no longer present in Dartmouth we will archive the subactivity in Planon.
+    if changed_since:
+        log.info(f"Delta fetch, changed since {changed_since}")
 
-log.info("# **************** Processing COA subactivities **************** #")
+    # All six segments are paged concurrently and streamed straight into keyed dicts, see ipaas.utils.get_coa_segments
+    fetch_kwargs = {
+        "segments": [segment.name for segment in SEGMENTS],
+        "keys": {segment.name: segment.dartmouth_key for segment in SEGMENTS},
+        "values": {segment.name: segment.compact for segment in SEGMENTS},
+        "changed_since": changed_since,
+    }
 
-log.info(f"Total number of Planon subactivities {len(planon_subactivities)}")
+    with metrics.timer("dartmouth_fetch") as timing:
+        if use_async:
+            dartmouth_coa_segments = asyncio.run(ipaas.utils.async_get_coa_segments(**fetch_kwargs))
+        else:
+            dartmouth_coa_segments = ipaas.utils.get_coa_segments(**fetch_kwargs)
 
-# ********************* INSERTS ********************* #
+        timing.records = sum(map(len, dartmouth_coa_segments.values()))
 
-# Inserts:
-inserts = set(dartmouth_subactivities) - set(planon_subactivities)
-log.info(f"Total number of subactivities to be inserted in Planon {len(inserts)}")
+# ***********************************************************************
+# Source PLANON Billing accounts
+# Loop through all chart of accounts in Planon
+# ***********************************************************************
 
-for insert in inserts:
-    log.info(f"Processing insert {insert}")
-    if insert:
-        try:
-            dartmouth_subactivity = dartmouth_subactivities[insert]
-            planon_subactivity = planon.UsrBillingAccounts.create(
-                values={
-                    "Code": dartmouth_subactivity["subactivity"],
-                    "Name": dartmouth_subactivity["subactivity_description"],
-                    "FreeString11": "SEG5",  # Segment type
-                }
-            )
-            log.info(f"Successfully added {insert}")
-            succeeded.append(insert)
+log.info("Getting chart of accounts segments from Planon")
 
-        except Exception as e:
-            log.exception(e)
-            log.info(f"Failed to add {insert}")
+# One query per segment type, filtered on the Planon side and run concurrently, see planon_utils.get_billing_accounts_by_type
+with metrics.timer("planon_fetch") as timing:
+    planon_coa_segments = planon_utils.get_billing_accounts_by_type([segment.segment_type for segment in SEGMENTS])
+    timing.records = sum(map(len, planon_coa_segments.values()))
 
-# ********************* ARCHIVES ********************* #
+# One pass over every billing account, duplicated keys are logged, see sync.partition_planon_segments
+planon_segments, planon_duplicates = partition_planon_segments(chain.from_iterable(planon_coa_segments.values()))
 
-# Archives subactivities in Planon, if it doesn't exist in Dartmouth
-archives = set(planon_subactivities) - set(dartmouth_subactivities)
-log.info(f"Total number of subactivities to be archived in Planon {len(archives)}")
+del planon_coa_segments
 
-for archive in archives:
-    log.info(f"Processing archive {archive}")
+log.info("From Dartmouth retrieved " + ", ".join(f"{len(dartmouth_coa_segments[segment.name])} {segment.label}" for segment in SEGMENTS))
 
-    try:
-        planon_subactivity = planon_subactivities[archive]
+log.info("From Planon retrieved " + ", ".join(f"{len(planon_segments[segment.name])} {segment.label}" for segment in SEGMENTS))
 
-        if planon_subactivity.IsArchived == False:
-            log.info(f"Archiving {planon_subactivity.Name} with {planon_subactivity.Code} ")
-            planon_subactivity.execute(bom="BomArchive")
+succeeded = []
+failed = []
+archived = []
+deferred = []
 
-            log.info(f"Successfully archived {planon_subactivity.Name} with {planon_subactivity.Code} ")
-            archived.append(planon_subactivity)
+# *********************************************************************
+# SEGMENTS
+# Each segment is diffed once into a plan of inserts, updates, archives
+# and reactivations, which is written out (--plan) or queued on a
+# WriteBatch and sent to Planon, see sync.SegmentSync
+# *********************************************************************
 
-    except Exception as e:
-        log.exception(e)
-        failed.append(archive)
+# A saved changeset, grouped per segment type
+applied_changes = {segment.segment_type: [] for segment in SEGMENTS}
 
-# *********************
-# NATURAL_CLASSES
-# *********************
+if args.apply:
+    for change in read_changeset(args.apply):
+        applied_changes[change.segment_type].append(change)
 
-log.info("# **************** Processing COA natural classes **************** #")
+planned_changes = []
 
-# ********************* INSERTS ********************* #
+# Every Planon write is journalled, so a run that dies can be picked up with --resume, see journal.Journal
+journal = None if args.plan else Journal(resume=args.resume)
 
-# Inserts:
-inserts = set(dartmouth_natural_classes) - set(planon_natural_classes)
-log.info(f"Total number of natural classes to be inserted in Planon {len(inserts)}")
+for segment in SEGMENTS:
+    dartmouth_segment = dartmouth_coa_segments[segment.name]
 
-for insert in inserts:
-    log.info(f"Processing insert {insert}")
+    only = None
 
-    try:
-        dartmouth_natural_class = dartmouth_natural_classes[insert]
+    if delta:
+        # Planon-only keys are not removals here, just records that didn't change
+        only = set(dartmouth_segment)
 
-        planon_natural_class = planon.UsrBillingAccounts.create(
-            values={
-                "Code": dartmouth_natural_class["natural_class"],
-                "Name": dartmouth_natural_class["natural_class_description"],
-                "FreeString11": "SEG6",  # Segment type
-            }
-        )
+        # without the field there is never a watermark: every delta run fetches the whole segment and archives nothing
+        if dartmouth_segment and all(record.last_update is None for record in dartmouth_segment.values()):
+            log.warning(f"No {segment.label} record has {ipaas.utils.DELTA_FIELD}, COA_DELTA can't move the watermark on, check COA_DELTA_FIELD")
 
-        log.info(f"Successfully added {insert}")
-        succeeded.append(insert)
+    if snapshot is not None and incremental:
+        if not delta and snapshot.is_empty(segment):
+            # nothing synced yet: a Planon-only record would never enter the snapshot, so diff the whole segment once
+            log.info(f"Snapshot has no {segment.label} yet, full diff")
+        else:
+            changed, removed = snapshot.changes(segment, dartmouth_segment)
+            only = changed if delta else changed | removed
 
-    except Exception as e:
-        log.exception(e)
-        failed.append(insert)
+    segment_sync = SegmentSync(
+        segment=segment,
+        dartmouth=dartmouth_segment,
+        planon=planon_segments[segment.name],
+        only=only,
+        journal=journal,
+    )
 
-# ********************* UPDATES ********************* #
+    if args.plan:
+        planned_changes += segment_sync.plan()
+        continue
 
-# Updates
-updates = set(dartmouth_natural_classes).intersection(set(planon_natural_classes))
-log.info(f"Total number of natural classes to be updated in Planon {len(updates)}")
+    if args.apply:
+        segment_succeeded, segment_failed, segment_archived = segment_sync.apply(applied_changes[segment.segment_type])
+    else:
+        segment_succeeded, segment_failed, segment_archived = segment_sync.run()
 
-for update in updates:
-    try:
-        dartmouth_natural_class = dartmouth_natural_classes[update]
-        planon_natural_class = planon_natural_classes[update]
+    succeeded += segment_succeeded
+    failed += segment_failed
+    archived += segment_archived
 
-        if dartmouth_natural_class["natural_class_description"] != planon_natural_class.Name:
-            log.info(f"Processing update {update}")
-            planon_natural_class.Name = dartmouth_natural_class["natural_class_description"]
-            planon_natural_class = planon_natural_class.save()
+    # writes the circuit breaker held back are left for the next run, like failed ones
+    segment_deferred = segment_sync.deferred
+    deferred += segment_deferred
 
-            log.info(f"Successfully updated {planon_natural_class.Name} with {planon_natural_class.Code} ")
-            succeeded.append(planon_natural_class)
+    if snapshot is not None and incremental:
+        snapshot.save(segment, dartmouth_segment, failed=segment_failed + segment_deferred, partial=delta)
 
-    except Exception as e:
-        log.exception(e)
-        failed.append(update)
+    # only move the watermark on when everything up to it made it into Planon
+    if snapshot is not None and delta and not segment_failed and not segment_deferred:
+        watermark = max((record.last_update for record in dartmouth_segment.values() if record.last_update is not None), default=None)
 
-# ********************* ARCHIVES ********************* #
+        if watermark is not None and (changed_since[segment.name] is None or watermark > changed_since[segment.name]):
+            snapshot.set_watermark(segment, watermark)
 
-# TODO - Do we need to archive natural_classes that are not in Dartmouth anymore?
-# Archives natural_classes in Planon, if it doesn't exist in Dartmouth
-archives = set(planon_natural_classes) - set(dartmouth_natural_classes)
-log.info(f"Total number of natural_classes to be archived in Planon {len(archives)}")
+if args.plan:
+    write_changeset(planned_changes, args.plan)
 
-for archive in archives:
-    log.info(f"Processing archive {archive}")
+if journal is not None:
+    # the run got to its end, a later --resume has nothing of it to skip
+    journal.finish()
+    journal.close()
 
-    try:
-        planon_natural_class = planon_natural_classes[archive]
+if snapshot is not None:
+    snapshot.close()
 
-        if planon_natural_class.IsArchived == False:
-            log.info(f"Archiving {planon_natural_class.Name} with {planon_natural_class.Code} ")
-            planon_natural_class.execute(bom="BomArchive")
+planon_utils.executor.shutdown()
 
-            log.info(f"Successfully archived {planon_natural_class.Name} with {planon_natural_class.Code} ")
-            archived.append(planon_natural_class)
+log.info(f"Finished in {datetime.utcnow() - start}: {len(succeeded)} succeeded, {len(failed)} failed, {len(archived)} archived, {len(deferred)} deferred")
 
-    except Exception as e:
-        log.exception(e)
-        failed.append(archive)
+if deferred:
+    log.warning(f"{len(deferred)} Planon writes were deferred by the circuit breaker, they are picked up by the next run (or --resume)")
 
+metrics.write()
@@ -0,0 +1,228 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - run report
+# wall time, calls, records and latency per (phase, segment), plus counters
+# such as retries and failed writes
+# *********************************************************************
+
+# JSON run report, empty to skip it
+REPORT_PATH = os.environ.get("COA_METRICS_REPORT", "coa_run_report.json")
+
+# optional Prometheus textfile (node_exporter textfile collector), e.g. /var/lib/node_exporter/coa.prom
+PROMETHEUS_PATH = os.environ.get("COA_METRICS_PROMETHEUS")
+
+PROMETHEUS_PREFIX = "coa_sync"
+
+# *********************************************************************
+# FUNCTIONS -
+# percentile: nearest-rank percentile of a list of samples
+# *********************************************************************
+
+
+def percentile(samples: List[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+
+    ordered = sorted(samples)
+
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+# *********************************************************************
+# CLASSES -
+# Timing: what a Metrics.timer block reports, records can be set inside it
+# Metrics: thread-safe collector, written out as a JSON run report and
+# optionally a Prometheus textfile
+# *********************************************************************
+
+
+class Timing:
+    def __init__(self, records: int = 0):
+        self.records = records
+
+
+class Metrics:
+    """Collects timings and counters from every thread of the run
+
+    A phase is anything timed: a whole fetch, one page, a diff or a single
+    Planon call. Each sample adds to the phase's wall time, call count and
+    record count, and is kept for the p50/p95 latency.
+    """
+
+    def __init__(self):
+        self.started = datetime.utcnow()
+        self.started_monotonic = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.samples: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+        self.records: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.counters: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def reset(self):
+        """Drops every sample and counter, e.g. in a worker process that runs several shards"""
+
+        with self.lock:
+            self.samples.clear()
+            self.records.clear()
+            self.counters.clear()
+
+    def observe(self, phase: str, segment: str, seconds: float, records: int = 0):
+        with self.lock:
+            self.samples[(phase, segment)].append(seconds)
+            self.records[(phase, segment)] += records
+
+    def count(self, name: str, segment: str = "", value: int = 1):
+        with self.lock:
+            self.counters[(name, segment)] += value
+
+    def state(self) -> Dict[str, Any]:
+        """Returns the raw samples and counters, picklable, for merge() in another process"""
+
+        with self.lock:
+            return {"samples": {key: list(values) for key, values in self.samples.items()}, "records": dict(self.records), "counters": dict(self.counters)}
+
+    def merge(self, state: Dict[str, Any]):
+        """Adds the samples and counters of state(), e.g. from a shard worker process"""
+
+        with self.lock:
+            for key, values in state["samples"].items():
+                self.samples[key].extend(values)
+
+            for key, records in state["records"].items():
+                self.records[key] += records
+
+            for key, value in state["counters"].items():
+                self.counters[key] += value
+
+    def observe_dartmouth_request(self, segment: str, seconds: float, records: int, retries: int = 0):
+        """An ipaas.utils request hook, one dartmouth_page sample per general_ledger page"""
+
+        self.observe("dartmouth_page", segment, seconds, records)
+
+        if retries:
+            self.count("dartmouth_retries", segment, retries)
+
+    @contextmanager
+    def timer(self, phase: str, segment: str = "", records: int = 0) -> Iterator[Timing]:
+        """Times the block as one sample of phase, also when it raises"""
+
+        timing = Timing(records)
+        start = time.perf_counter()
+
+        try:
+            yield timing
+        finally:
+            self.observe(phase, segment, time.perf_counter() - start, timing.records)
+
+    def report(self) -> Dict[str, Any]:
+        """Returns the run report
+
+        Returns:
+            _type_: dict, with one entry per (phase, segment) and per counter
+        """
+
+        with self.lock:
+            samples = {key: list(values) for key, values in self.samples.items()}
+            records = dict(self.records)
+            counters = dict(self.counters)
+
+        phases = []
+
+        for (phase, segment), values in sorted(samples.items()):
+            seconds = sum(values)
+
+            phases.append(
+                {
+                    "phase": phase,
+                    "segment": segment,
+                    "calls": len(values),
+                    "seconds": round(seconds, 6),
+                    "records": records[(phase, segment)],
+                    "records_per_second": round(records[(phase, segment)] / seconds, 3) if seconds > 0 else None,
+                    "p50_seconds": percentile(values, 0.5),
+                    "p95_seconds": percentile(values, 0.95),
+                    "max_seconds": max(values),
+                }
+            )
+
+        return {
+            "started": self.started.isoformat() + "Z",
+            "seconds": round(time.monotonic() - self.started_monotonic, 6),
+            "phases": phases,
+            "counters": [{"name": name, "segment": segment, "value": value} for (name, segment), value in sorted(counters.items())],
+        }
+
+    def prometheus(self, report: Optional[Dict[str, Any]] = None) -> str:
+        """Returns the report in the Prometheus text exposition format"""
+
+        report = report or self.report()
+
+        def labels(**values: str) -> str:
+            return "{" + ",".join(f'{name}="{value}"' for name, value in values.items()) + "}"
+
+        lines = [
+            f"# TYPE {PROMETHEUS_PREFIX}_run_seconds gauge",
+            f"{PROMETHEUS_PREFIX}_run_seconds {report['seconds']}",
+            f"# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge",
+            f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds {time.time():.0f}",
+        ]
+
+        for metric, field in (("phase_seconds", "seconds"), ("phase_calls", "calls"), ("phase_records", "records")):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} gauge")
+            lines += [f"{PROMETHEUS_PREFIX}_{metric}{labels(phase=entry['phase'], segment=entry['segment'])} {entry[field]}" for entry in report["phases"]]
+
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_phase_latency_seconds gauge")
+
+        for entry in report["phases"]:
+            for quantile, field in (("0.5", "p50_seconds"), ("0.95", "p95_seconds")):
+                lines.append(f"{PROMETHEUS_PREFIX}_phase_latency_seconds{labels(phase=entry['phase'], segment=entry['segment'], quantile=quantile)} {entry[field]}")
+
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_count gauge")
+        lines += [f"{PROMETHEUS_PREFIX}_count{labels(name=entry['name'], segment=entry['segment'])} {entry['value']}" for entry in report["counters"]]
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Optional[str] = REPORT_PATH, prometheus_path: Optional[str] = PROMETHEUS_PATH) -> Dict[str, Any]:
+        """Writes the JSON report and the Prometheus textfile, whichever has a path
+
+        Both are written to a temporary file first and renamed, so a collector
+        never reads half a file.
+
+        Returns:
+            _type_: dict, the report
+        """
+
+        report = self.report()
+
+        for target, content in ((path, lambda: json.dumps(report, indent=2)), (prometheus_path, lambda: self.prometheus(report))):
+            if not target:
+                continue
+
+            with open(f"{target}.tmp", "w") as report_file:
+                report_file.write(content())
+
+            os.replace(f"{target}.tmp", target)
+
+            log.info(f"Wrote run metrics to {target}")
+
+        return report
+
+
+# one collector per run, shared by planon_utils, sync and main.py
+metrics = Metrics()
@@ -0,0 +1,482 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import planon
+import requests
+
+import audit
+from journal import Journal
+from metrics import metrics
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - write batching, workers and rate limit for UsrBillingAccounts
+# *********************************************************************
+
+# records sent per chunk, the next chunk starts once the previous one is done
+CHUNK_SIZE = int(os.environ.get("PLANON_CHUNK_SIZE", 100))
+
+# single-record calls in flight, shared by every segment; adjusted between
+# PLANON_MIN_WORKERS and PLANON_MAX_WORKERS, starting at PLANON_INITIAL_WORKERS
+MAX_WORKERS = int(os.environ.get("PLANON_MAX_WORKERS", 8))
+MIN_WORKERS = int(os.environ.get("PLANON_MIN_WORKERS", 1))
+INITIAL_WORKERS = int(os.environ.get("PLANON_INITIAL_WORKERS", max(MAX_WORKERS // 2, MIN_WORKERS)))
+
+# AIMD: one more call in flight per round of calls answered within the latency target,
+# the limit is multiplied by the decrease ratio (at most once per target) on an error or a slow call
+LATENCY_TARGET = float(os.environ.get("PLANON_LATENCY_TARGET", 2.0))
+DECREASE_RATIO = float(os.environ.get("PLANON_DECREASE_RATIO", 0.5))
+
+# consecutive failed calls that open the circuit breaker (0 = never), and seconds before a probe call is let through;
+# only throttling, 5xx, timeouts and connection errors count, see is_overload
+BREAKER_THRESHOLD = int(os.environ.get("PLANON_BREAKER_THRESHOLD", 20))
+BREAKER_COOLDOWN = float(os.environ.get("PLANON_BREAKER_COOLDOWN", 60))
+
+# calls started per second across all workers (0 = unlimited) and how many may start back to back
+RATE_LIMIT = float(os.environ.get("PLANON_RATE_LIMIT", 0))
+BURST = int(os.environ.get("PLANON_BURST", MAX_WORKERS))
+
+# statuses that mean Planon is throttling or failing, rather than refusing one record
+OVERLOAD_CODES = (429, 500, 502, 503, 504)
+
+# segment types queried from Planon at the same time
+READ_WORKERS = int(os.environ.get("PLANON_READ_WORKERS", 6))
+
+CREATE = "create"
+SAVE = "save"
+ARCHIVE = "archive"
+REACTIVATE = "reactivate"
+
+# BOMs executed on UsrBillingAccounts to archive and to un-archive a record
+ARCHIVE_BOM = os.environ.get("PLANON_ARCHIVE_BOM", "BomArchive")
+REACTIVATE_BOM = os.environ.get("PLANON_REACTIVATE_BOM", "BomReactivate")
+
+# *********************************************************************
+# FUNCTIONS -
+# is_overload: whether a failed call says Planon is struggling
+# get_billing_accounts: UsrBillingAccounts of one segment type, filtered
+# on the Planon side
+# get_billing_accounts_by_type: the same for several types, concurrently
+# *********************************************************************
+
+
+def is_overload(error: BaseException) -> bool:
+    """Whether the error is throttling, a 5xx, a timeout or a connection error
+
+    Anything else (e.g. a validation error on one record) only fails that
+    record, it says nothing about Planon's health.
+    """
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None) or getattr(error, "status_code", None)
+
+    return status in OVERLOAD_CODES
+
+
+def get_billing_accounts(segment_type: str, include_archived: bool = True) -> List[Any]:
+    """Returns the UsrBillingAccounts with FreeString11 == segment_type
+
+    Args:
+        segment_type (str): SEG1..SEG6
+        include_archived (bool): False leaves archived rows out, only safe where
+            an archived row does not matter (they still block an insert of the same code)
+    Returns:
+        _type_: list[UsrBillingAccounts]
+    """
+
+    segments_filter: Dict[str, Any] = {
+        "filter": {
+            "FreeString11": {"eq": segment_type},  # Segment type
+        }
+    }
+
+    if not include_archived:
+        segments_filter["filter"]["IsArchived"] = {"eq": False}
+
+    with metrics.timer("planon_read", segment_type) as timing:
+        billing_accounts = planon.UsrBillingAccounts.find(segments_filter)
+        timing.records = len(billing_accounts)
+
+    log.debug(f"Retrieved {len(billing_accounts)} {segment_type} billing accounts from Planon")
+
+    return billing_accounts
+
+
+def get_billing_accounts_by_type(segment_types: Sequence[str], include_archived: bool = True, max_workers: int = READ_WORKERS) -> Dict[str, List[Any]]:
+    """Returns get_billing_accounts for every segment type, queried concurrently
+
+    Returns:
+        _type_: dict[str, list[UsrBillingAccounts]], keyed by segment type
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="planon-read") as pool:
+        futures = {segment_type: pool.submit(get_billing_accounts, segment_type, include_archived) for segment_type in segment_types}
+
+        return {segment_type: future.result() for segment_type, future in futures.items()}
+
+
+# *********************************************************************
+# CLASSES -
+# TokenBucket: rate limiter shared by the executor's workers
+# AdaptiveConcurrency: AIMD limit on the calls in flight
+# CircuitBreaker: stop calling Planon after a run of failures, probe again
+# after a cooldown
+# PlanonExecutor: one thread pool for every Planon mutation in the run
+# WriteBatch: queue creates, saves, archives and reactivations, then flush
+# them in chunks and sort the outcome into succeeded/failed/archived
+# *********************************************************************
+
+
+class TokenBucket:
+    """Thread-safe token bucket, `rate` tokens a second up to `capacity`"""
+
+    def __init__(self, rate: float = RATE_LIMIT, capacity: int = BURST):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, returns at once when rate is 0"""
+
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """Limits the calls in flight, raising the limit additively while Planon keeps up and cutting it multiplicatively when it doesn't"""
+
+    def __init__(
+        self,
+        initial: int = INITIAL_WORKERS,
+        minimum: int = MIN_WORKERS,
+        maximum: int = MAX_WORKERS,
+        latency_target: float = LATENCY_TARGET,
+        decrease_ratio: float = DECREASE_RATIO,
+    ):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.decrease_ratio = decrease_ratio
+
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Blocks until the call fits under the current limit"""
+
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+
+            self.in_flight += 1
+
+    def release(self, latency: Optional[float] = None, ok: bool = True):
+        """Frees the slot and adjusts the limit, a call that wasn't made passes no latency"""
+
+        with self.condition:
+            self.in_flight -= 1
+
+            if latency is not None and ok and latency <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            # calls already in flight when Planon slowed down would cut the limit again, one cut per target
+            elif latency is not None and time.monotonic() - self.decreased_at >= self.latency_target:
+                self.limit = max(self.minimum, self.limit * self.decrease_ratio)
+                self.decreased_at = time.monotonic()
+
+                log.info(f"Planon {'slow' if ok else 'failing'}, lowering concurrency to {int(self.limit)}")
+
+            self.condition.notify_all()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Planon while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures, lets one probe call through after `cooldown` seconds
+
+    Calls made while the probe is out wait for its outcome.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.condition = threading.Condition()
+
+    def allow(self) -> bool:
+        with self.condition:
+            while self.state == self.HALF_OPEN:
+                self.condition.wait()
+
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                log.info("Planon circuit breaker half-open, sending a probe call")
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def record(self, ok: bool):
+        with self.condition:
+            self.condition.notify_all()
+
+            if ok:
+                if self.state != self.CLOSED:
+                    log.info("Planon circuit breaker closed")
+
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+
+            self.failures += 1
+
+            if self.threshold > 0 and (self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold)):
+                log.warning(f"Planon circuit breaker open after {self.failures} consecutive failures, deferring writes for {self.cooldown}s")
+                metrics.count("planon_breaker_trips")
+
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class PlanonExecutor:
+    """Thread pool for Planon calls
+
+    Every call waits for a token from the rate limiter and a slot from the
+    adaptive concurrency limit, and is refused with CircuitOpenError while the
+    circuit breaker is open.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = MAX_WORKERS,
+        rate_limiter: Optional[TokenBucket] = None,
+        concurrency: Optional[AdaptiveConcurrency] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.concurrency = concurrency or AdaptiveConcurrency(maximum=max_workers)
+        self.breaker = breaker or CircuitBreaker()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="planon-write")
+
+    def _call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        if not self.breaker.allow():
+            raise CircuitOpenError("Planon circuit breaker is open")
+
+        self.rate_limiter.acquire()
+        self.concurrency.acquire()
+
+        start = time.perf_counter()
+
+        try:
+            result = fn(*args, **kwargs)
+
+        except Exception as e:
+            # a record Planon refused was still answered, only overload counts against the limit and the breaker
+            overload = is_overload(e)
+
+            self.concurrency.release(time.perf_counter() - start, ok=not overload)
+            self.breaker.record(not overload)
+            raise
+
+        self.concurrency.release(time.perf_counter() - start)
+        self.breaker.record(True)
+
+        return result
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        return self.pool.submit(self._call, fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        self.pool.shutdown(wait=wait)
+
+
+# threads are only started on first use, so importing this module stays cheap
+executor = PlanonExecutor()
+
+
+class WriteBatch:
+    """Queues UsrBillingAccounts mutations and sends them to Planon in chunks
+
+    libplanon-rest only exposes single-record create/save/execute calls, so
+    each chunk is sent as concurrent single calls on the shared executor.
+    """
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, executor: PlanonExecutor = executor, journal: Optional[Journal] = None, scope: str = ""):
+        """
+        Args:
+            journal (Journal): optional, every operation is journalled as planned
+                and then done or failed with the code and name written, operations
+                it has as done with the same code and name are skipped
+            scope (str): journal scope of the operations, the segment type
+        """
+
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.journal = journal
+        self.scope = scope
+        # (operation, key, (code, name) written, target, call)
+        self.operations: List[Tuple[str, Hashable, Tuple[Optional[str], Optional[str]], Any, Callable[[], Any]]] = []
+
+        # keys refused by the open circuit breaker, not sent and still planned in the journal
+        self.deferred: List[Any] = []
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+    def queue(self, operation: str, key: Hashable, target: Any, call: Callable[[], Any], code: Optional[str] = None, name: Optional[str] = None):
+        if self.journal is not None:
+            if self.journal.is_done(operation, self.scope, key, code, name):
+                audit.record(log, "skipped", self.scope, key, f"Skipping {operation} {key}, already done in the resumed run", operation=operation)
+                return
+
+            self.journal.planned(operation, self.scope, key, code, name)
+
+        self.operations.append((operation, key, (code, name), target, self.timed(operation, call)))
+
+    def timed(self, operation: str, call: Callable[[], Any]) -> Callable[[], Any]:
+        """Wraps call so its latency is reported as the planon_<operation> phase, the rate limiter's wait excluded"""
+
+        def timed_call():
+            with metrics.timer(f"planon_{operation}", self.scope, records=1):
+                return call()
+
+        return timed_call
+
+    def create(self, key: Hashable, values: dict):
+        self.queue(CREATE, key, values, lambda: planon.UsrBillingAccounts.create(values=values), values.get("Code"), values.get("Name"))
+
+    def save(self, key: Hashable, record: Any):
+        self.queue(SAVE, key, record, record.save, record.Code, record.Name)
+
+    def archive(self, key: Hashable, record: Any):
+        self.queue(ARCHIVE, key, record, lambda: record.execute(bom=ARCHIVE_BOM), record.Code, record.Name)
+
+    def reactivate(self, key: Hashable, record: Any, name: Optional[str] = None):
+        """Un-archives the record, and renames it when name differs from its Name"""
+
+        def call():
+            record.execute(bom=REACTIVATE_BOM)
+
+            if name is not None and name != record.Name:
+                record.Name = name
+                record.save()
+
+            return record
+
+        self.queue(REACTIVATE, key, record, call, record.Code, record.Name if name is None else name)
+
+    def flush(self) -> Tuple[List[Any], List[Any], List[Any]]:
+        """Sends every queued operation and empties the queue
+
+        Returns:
+            _type_: (succeeded, failed, archived), with the same entries main.py
+            always appended: the key of a created record, the saved (or
+            reactivated) record, the archived record and the key of any failed
+            operation; deferred keys are added to self.deferred instead
+        """
+
+        succeeded: List[Any] = []
+        failed: List[Any] = []
+        archived: List[Any] = []
+
+        operations, self.operations = self.operations, []
+        deferred = 0
+
+        if not operations:
+            return succeeded, failed, archived
+
+        for offset in range(0, len(operations), self.chunk_size):
+            chunk = operations[offset : offset + self.chunk_size]
+
+            log.debug(f"Sending operations {offset + 1} to {offset + len(chunk)} of {len(operations)}")
+
+            futures = [self.executor.submit(call) for _, _, _, _, call in chunk]
+
+            for (operation, key, change, target, _), future in zip(chunk, futures):
+                error = future.exception()
+
+                if isinstance(error, CircuitOpenError):
+                    log.debug(f"Deferred {operation} {key}")
+                    metrics.count("planon_deferred", self.scope)
+                    self.deferred.append(key)
+                    deferred += 1
+                    continue
+
+                if self.journal is not None:
+                    if error is None:
+                        self.journal.completed(operation, self.scope, key, *change)
+                    else:
+                        self.journal.failed(operation, self.scope, key, *change)
+
+                if error is not None:
+                    # in batched mode the error is kept in the audit trail entry, not logged with its traceback
+                    if audit.trail is None:
+                        log.error(error, exc_info=error)
+
+                    audit.record(log, "failed", self.scope, key, f"Failed to {operation} {key}", operation=operation, error=repr(error))
+                    metrics.count(f"planon_{operation}_failed", self.scope)
+                    failed.append(key)
+
+                elif operation == CREATE:
+                    audit.record(log, "created", self.scope, key, f"Successfully added {key}")
+                    succeeded.append(key)
+
+                elif operation == SAVE:
+                    record = future.result()
+                    audit.record(log, "saved", self.scope, key, f"Successfully updated {record.Name} with {record.Code} ", code=record.Code, name=record.Name)
+                    succeeded.append(record)
+
+                elif operation == ARCHIVE:
+                    audit.record(log, "archived", self.scope, key, f"Successfully archived {target.Name} with {target.Code} ", code=target.Code, name=target.Name)
+                    archived.append(target)
+
+                elif operation == REACTIVATE:
+                    audit.record(log, "reactivated", self.scope, key, f"Successfully reactivated {target.Name} with {target.Code} ", code=target.Code, name=target.Name)
+                    succeeded.append(target)
+
+        if deferred:
+            log.warning(f"Deferred {deferred} of {len(operations)} {self.scope} operations, the Planon circuit breaker is open")
+
+        return succeeded, failed, archived
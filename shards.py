@@ -0,0 +1,177 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, Hashable, List, NamedTuple, Sequence, Tuple
+
+import planon
+import ipaas.utils
+
+import audit
+import planon_utils
+from journal import JOURNAL_PATH, Journal
+from metrics import metrics
+from sync import SEGMENTS, Segment, SegmentSync, partition_planon_segments
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - process-sharded full sync
+# one worker process per shard, a segment type; each worker reads its own
+# segment from Dartmouth and Planon and sends its own writes, the parent
+# merges the results
+# *********************************************************************
+
+# *********************************************************************
+# CLASSES -
+# Shard: the segment one worker synchronises
+# ShardResult: what a worker sends back, keys only, the Planon records
+# themselves stay in the worker
+# *********************************************************************
+
+
+class Shard(NamedTuple):
+    segment: Segment
+
+    @property
+    def name(self) -> str:
+        return self.segment.name
+
+
+class ShardResult(NamedTuple):
+    name: str
+    succeeded: List[Hashable]
+    failed: List[Hashable]
+    archived: List[Hashable]
+    deferred: List[Hashable]
+    metrics: Dict[str, Any]
+
+
+# *********************************************************************
+# FUNCTIONS -
+# get_shards: one shard per segment
+# run_shard: full sync of one shard, in a worker process
+# run_sharded: every shard on a process pool, results and metrics merged
+# *********************************************************************
+
+
+def get_shards(segments: Sequence[Segment] = SEGMENTS) -> List[Shard]:
+    # a segment isn't split further: every part would read and decode the whole segment from both APIs again
+    return [Shard(segment) for segment in segments]
+
+
+def shard_journal_path(shard: Shard, path: str = JOURNAL_PATH) -> str:
+    root, extension = os.path.splitext(path)
+
+    return f"{root}.{shard.name}{extension}"
+
+
+def run_shard(shard: Shard, resume: bool = False) -> ShardResult:
+    """Synchronises one shard with its own iPaaS session and Planon client
+
+    Returns:
+        _type_: ShardResult, with the keys of the succeeded, failed, archived and deferred writes
+    """
+
+    segment = shard.segment
+
+    planon.PlanonResource.set_site(site=os.environ["PLANON_API_URL"])
+    planon.PlanonResource.set_header(jwt=os.environ["PLANON_API_KEY"])
+
+    session = ipaas.utils.create_session()
+    ipaas.utils.jwt_provider.session = session
+
+    # the worker's metrics only hold this shard, whatever the process ran (or inherited) before
+    metrics.reset()
+
+    if metrics.observe_dartmouth_request not in ipaas.utils.request_hooks:
+        ipaas.utils.request_hooks.append(metrics.observe_dartmouth_request)
+
+    audit.start_shard(shard.name)
+
+    try:
+        log.info(f"Shard {shard.name} starting in process {os.getpid()}")
+
+        with metrics.timer("dartmouth_fetch", segment.name) as timing:
+            dartmouth = ipaas.utils.get_coa_segment_dict(segment.name, key=segment.dartmouth_key, value=segment.compact, session=session)
+            timing.records = len(dartmouth)
+
+        with metrics.timer("planon_fetch", segment.name) as timing:
+            planon_segments, _ = partition_planon_segments(planon_utils.get_billing_accounts(segment.segment_type), [segment])
+            planon_segment = planon_segments[segment.name]
+            timing.records = len(planon_segment)
+
+        journal = Journal(path=shard_journal_path(shard), resume=resume)
+
+        segment_sync = SegmentSync(segment=segment, dartmouth=dartmouth, planon=planon_segment, journal=journal)
+        succeeded, failed, archived = segment_sync.run()
+
+        # the executor's threads are kept for the next shard this worker runs
+        journal.finish()
+        journal.close()
+
+    finally:
+        # the worker exits without atexit handlers, and runs the next shard after a failed one:
+        # the audit trail and queued log records are flushed here either way
+        audit.stop()
+
+    # saved and archived entries are Planon records, only their keys cross the process boundary
+    def keys(entries: List[Any]) -> List[Hashable]:
+        return [segment.planon_key(entry) if hasattr(entry, "Code") else entry for entry in entries]
+
+    return ShardResult(shard.name, keys(succeeded), keys(failed), keys(archived), list(segment_sync.deferred), metrics.state())
+
+
+def run_sharded(
+    shards: Sequence[Shard], processes: int, resume: bool = False
+) -> Tuple[List[Hashable], List[Hashable], List[Hashable], List[Hashable], List[str]]:
+    """Runs every shard in a worker process and merges their results and metrics
+
+    Workers are forked, so main.py (a plain script) isn't imported again in
+    them; nothing has opened a connection or started a thread at that point,
+    main.py only starts batched logging (audit.start) after the sharded run
+    and every worker starts its own (audit.start_shard).
+
+    Returns:
+        _type_: (succeeded, failed, archived, deferred) keys across all shards,
+            and the names of the shards that raised
+    """
+
+    succeeded: List[Hashable] = []
+    failed: List[Hashable] = []
+    archived: List[Hashable] = []
+    deferred: List[Hashable] = []
+    failed_shards: List[str] = []
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork")) as pool:
+        futures = {pool.submit(run_shard, shard, resume): shard for shard in shards}
+
+        for future in as_completed(futures):
+            shard = futures[future]
+
+            try:
+                result = future.result()
+
+            except Exception as e:
+                # the shard's writes are journalled, --resume picks it up again
+                log.exception(e)
+                log.error(f"Shard {shard.name} failed")
+                failed_shards.append(shard.name)
+                continue
+
+            log.info(
+                f"Shard {result.name} done: {len(result.succeeded)} succeeded, {len(result.failed)} failed, {len(result.archived)} archived, {len(result.deferred)} deferred"
+            )
+
+            metrics.merge(result.metrics)
+
+            succeeded += result.succeeded
+            failed += result.failed
+            archived += result.archived
+            deferred += result.deferred
+
+    return succeeded, failed, archived, deferred, failed_shards
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from sync import COARecord, Segment
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SETUP - local snapshot of the last synced state
+# one row per (segment type, key) with a hash of the values sent to Planon
+# and one delta watermark per segment
+# *********************************************************************
+
+SNAPSHOT_PATH = os.environ.get("COA_SNAPSHOT_PATH", "coa_snapshot.sqlite3")
+
+# *********************************************************************
+# FUNCTIONS -
+# encode_key: dict keys (str or tuple) as a stable TEXT column
+# record_hash: hash of the fields a segment maps into Planon
+# *********************************************************************
+
+
+def encode_key(key: Hashable) -> str:
+    return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+
+def record_hash(segment: Segment, record: COARecord) -> str:
+    return hashlib.sha1(json.dumps(segment.values(record), sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# *********************************************************************
+# CLASSES -
+# Snapshot: read the keys that changed since the last run and write the
+# state that made it into Planon
+# *********************************************************************
+
+
+class Snapshot:
+    """SQLite backed snapshot of the last synced Dartmouth state
+
+    Only the Dartmouth side is tracked, edits made directly in Planon are not
+    seen by an incremental run, a full run picks them up.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS snapshot (segment_type TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (segment_type, key))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS watermark (segment_type TEXT PRIMARY KEY, changed_since TEXT NOT NULL)")
+
+    def close(self):
+        self.connection.close()
+
+    def load(self, segment: Segment) -> Dict[str, str]:
+        rows = self.connection.execute("SELECT key, hash FROM snapshot WHERE segment_type = ?", (segment.segment_type,))
+
+        return dict(rows)
+
+    def is_empty(self, segment: Segment) -> bool:
+        """Whether the segment has never been saved, e.g. on the first incremental run"""
+
+        return self.connection.execute("SELECT 1 FROM snapshot WHERE segment_type = ? LIMIT 1", (segment.segment_type,)).fetchone() is None
+
+    def changes(self, segment: Segment, dartmouth: Dict[Hashable, COARecord]) -> Tuple[Set[Hashable], Set[Hashable]]:
+        """Returns the Dartmouth keys that are new or changed and the snapshot keys no longer in Dartmouth
+
+        Returns:
+            _type_: (set[key], set[key]), the removed keys are decoded back to dict keys
+        """
+
+        previous = self.load(segment)
+
+        changed = set()
+
+        for key, record in dartmouth.items():
+            if previous.pop(encode_key(key), None) != record_hash(segment, record):
+                changed.add(key)
+
+        # whatever is left was synced before and is gone from Dartmouth now
+        removed = {tuple(key) if isinstance(key, list) else key for key in map(json.loads, previous)}
+
+        log.info(f"Snapshot has {len(changed)} new or changed and {len(removed)} removed {segment.label}")
+
+        return changed, removed
+
+    def get_watermark(self, segment: Segment) -> Optional[str]:
+        row = self.connection.execute("SELECT changed_since FROM watermark WHERE segment_type = ?", (segment.segment_type,)).fetchone()
+
+        return row[0] if row else None
+
+    def set_watermark(self, segment: Segment, changed_since: str):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO watermark (segment_type, changed_since) VALUES (?, ?)", (segment.segment_type, changed_since))
+
+    def save(self, segment: Segment, dartmouth: Dict[Hashable, COARecord], failed: Iterable[Any] = (), partial: bool = False):
+        """Replaces the segment's snapshot with the current Dartmouth state
+
+        Keys that failed keep their previous row (or get none), so the next
+        incremental run picks them up again. A partial (delta) state is merged
+        into the snapshot instead of replacing it.
+        """
+
+        failed_keys = {encode_key(key) for key in failed if isinstance(key, Hashable)}
+        previous = self.load(segment)
+
+        rows = {encode_key(key): record_hash(segment, record) for key, record in dartmouth.items()}
+
+        for key in failed_keys:
+            rows.pop(key, None)
+
+            if key in previous:
+                rows[key] = previous[key]
+
+        if partial:
+            rows = dict(previous, **rows)
+
+        with self.connection:
+            self.connection.execute("DELETE FROM snapshot WHERE segment_type = ?", (segment.segment_type,))
+            self.connection.executemany(
+                "INSERT INTO snapshot (segment_type, key, hash) VALUES (?, ?, ?)", ((segment.segment_type, key, row_hash) for key, row_hash in rows.items())
+            )
+
+        log.debug(f"Saved {len(rows)} {segment.label} to snapshot {self.path}")
@@ -0,0 +1,469 @@
+import logging
+from typing import Any, Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import ipaas.utils
+
+import audit
+import columnar
+import planon_utils
+from journal import Journal
+from metrics import metrics
+
+# *********************************************************************
+# LOGGING - set of log messages
+# *********************************************************************
+
+log = logging.getLogger(__name__)
+
+# *********************************************************************
+# SEGMENTS - one row per chart of accounts segment
+# name: iPaaS general_ledger segment
+# segment_type: Planon FreeString11 / SegmentType
+# code_field, description_field: iPaaS fields mapped to Code and Name,
+# kept per record as a COARecord
+# composite_key: keyed on (code, description) instead of code
+# *********************************************************************
+
+
+class COARecord(NamedTuple):
+    """The fields of a general_ledger record the sync reads, in place of the decoded dict"""
+
+    code: str
+    description: str
+    last_update: Optional[str] = None
+
+
+class Change(NamedTuple):
+    """One planned Planon mutation: create, save (rename), archive or reactivate"""
+
+    operation: str
+    segment_type: str
+    key: Hashable
+    code: str
+    name: str
+
+
+class Segment(NamedTuple):
+    name: str
+    segment_type: str
+    code_field: str
+    description_field: str
+    composite_key: bool = False
+
+    @property
+    def label(self) -> str:
+        return self.name.replace("_", " ")
+
+    def dartmouth_key(self, record: Dict[str, Any]) -> Hashable:
+        if self.composite_key:
+            return (record[self.code_field], record[self.description_field])
+
+        return record[self.code_field]
+
+    def planon_key(self, record: Any) -> Hashable:
+        if self.composite_key:
+            return (record.Code, record.Name)
+
+        return record.Code
+
+    def compact(self, record: Dict[str, Any]) -> COARecord:
+        last_update = record.get(ipaas.utils.DELTA_FIELD)
+
+        return COARecord(record[self.code_field], record[self.description_field], None if last_update is None else str(last_update))
+
+    def values(self, record: COARecord) -> Dict[str, Any]:
+        return {
+            "Code": record.code,
+            "Name": record.description,
+            "FreeString11": self.segment_type,  # Segment type
+        }
+
+    def planon_values(self, record: Any) -> Dict[str, Any]:
+        """The values of a Planon record, to compare with values()"""
+
+        return {
+            "Code": record.Code,
+            "Name": record.Name,
+            "FreeString11": record.SegmentType,
+        }
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self.values(COARecord("", "")))
+
+    def columns(self, records: Iterable[COARecord]) -> Dict[str, List[Any]]:
+        """values() of every record, as one list per field, see columnar.reconcile"""
+
+        records = list(records)
+
+        return {
+            "Code": [record.code for record in records],
+            "Name": [record.description for record in records],
+            "FreeString11": [self.segment_type] * len(records),
+        }
+
+    def planon_columns(self, records: Iterable[Any]) -> Dict[str, List[Any]]:
+        """planon_values() of every record, as one list per field"""
+
+        records = list(records)
+
+        return {
+            "Code": [record.Code for record in records],
+            "Name": [record.Name for record in records],
+            "FreeString11": [record.SegmentType for record in records],
+        }
+
+
+# Subactivities are handled differently than the other segments because they are not a 1:1 mapping between Dartmouth and Planon.
+# Unlike the other segments the subactivity is a child of the activity and the codes are not unique.
+# The subactivity is unique within a given activity.
+# We do not want to show multiple subactivities of the same code in the UI, instead we will ensure that there is at least one subactivity for a given code + description.
+# If a code + description is no longer present in Dartmouth we will archive the subactivity in Planon.
+SEGMENTS = (
+    Segment("entities", "SEG1", "entity", "entity_description"),
+    Segment("orgs", "SEG2", "org", "org_description"),
+    Segment("fundings", "SEG3", "funding", "funding_description"),
+    Segment("activities", "SEG4", "activity", "activity_description"),
+    Segment("subactivities", "SEG5", "subactivity", "subactivity_description", composite_key=True),
+    Segment("natural_classes", "SEG6", "natural_class", "natural_class_description"),
+)
+
+# *********************************************************************
+# FUNCTIONS -
+# partition_planon_segments: split the Planon billing accounts into one
+# keyed dict per segment in a single pass, keeping track of duplicates
+# *********************************************************************
+
+
+def partition_planon_segments(
+    records: Iterable[Any], segments: Sequence[Segment] = SEGMENTS
+) -> Tuple[Dict[str, Dict[Hashable, Any]], Dict[str, Dict[Hashable, List[Any]]]]:
+    """Returns the Planon records keyed per segment, plus any duplicate keys
+
+    When a key occurs more than once, an active record is kept over an archived
+    one, otherwise the last record seen wins (as the per-segment comprehensions did).
+
+    Returns:
+        _type_: (dict[segment name, dict[key, record]], dict[segment name, dict[key, list[record]]])
+    """
+
+    by_type = {segment.segment_type: segment for segment in segments}
+
+    planon_segments: Dict[str, Dict[Hashable, Any]] = {segment.name: {} for segment in segments}
+    duplicates: Dict[str, Dict[Hashable, List[Any]]] = {segment.name: {} for segment in segments}
+
+    for record in records:
+        segment = by_type.get(record.SegmentType)
+
+        if segment is None:
+            continue
+
+        keyed = planon_segments[segment.name]
+        key = segment.planon_key(record)
+
+        existing = keyed.get(key)
+
+        if existing is not None:
+            duplicates[segment.name].setdefault(key, [existing]).append(record)
+
+            if existing.IsArchived == False and record.IsArchived != False:
+                continue
+
+        keyed[key] = record
+
+    for segment in segments:
+        if duplicates[segment.name]:
+            log.warning(f"Planon has {len(duplicates[segment.name])} duplicated {segment.label} keys: {sorted(map(str, duplicates[segment.name]))}")
+
+    return planon_segments, duplicates
+
+
+# *********************************************************************
+# CLASSES -
+# SegmentSync: diff one segment between Dartmouth and Planon once, plan
+# the inserts, updates, archives and reactivations as Changes, then queue
+# them on a WriteBatch and flush it
+# *********************************************************************
+
+
+class SegmentSync:
+    """Synchronises one chart of accounts segment from Dartmouth into Planon"""
+
+    def __init__(
+        self,
+        segment: Segment,
+        dartmouth: Dict[Hashable, COARecord],
+        planon: Dict[Hashable, Any],
+        batch: Optional[planon_utils.WriteBatch] = None,
+        only: Optional[Set[Hashable]] = None,
+        journal: Optional[Journal] = None,
+    ):
+        """
+        Args:
+            only (set): when given, only these keys are considered, e.g. the
+                keys a Snapshot reports as changed or removed
+            journal (Journal): optional, journals the segment's writes, see WriteBatch
+        """
+
+        self.segment = segment
+        self.dartmouth = dartmouth
+        self.planon = planon
+        self.batch = batch or planon_utils.WriteBatch(journal=journal, scope=segment.segment_type)
+        self.only = only
+
+        self.failed: List[Any] = []
+
+        self.inserts: Set[Hashable] = set()
+        self.updates: Set[Hashable] = set()
+        self.archives: Set[Hashable] = set()
+        self.reactivates: Set[Hashable] = set()
+
+    @property
+    def deferred(self) -> List[Any]:
+        """Keys whose write was deferred by the open Planon circuit breaker, see planon_utils.CircuitBreaker"""
+
+        return self.batch.deferred
+
+    def diff(self) -> Tuple[Set[Hashable], Set[Hashable], Set[Hashable], Set[Hashable]]:
+        """Returns the keys to insert, to check for updates, to archive and to reactivate
+
+        Only active Planon records are archived and only archived ones are
+        reactivated, so both sets scale with the changes rather than with the
+        archived history.
+        """
+
+        dartmouth_keys = set(self.dartmouth)
+        planon_keys = set(self.planon)
+
+        if self.only is not None:
+            dartmouth_keys &= self.only
+            planon_keys &= self.only
+
+        archived_keys = {key for key in planon_keys if self.planon[key].IsArchived != False}
+
+        inserts = dartmouth_keys - planon_keys
+
+        # codes that are back in Dartmouth, their rename is part of the reactivation
+        reactivates = dartmouth_keys & archived_keys
+
+        # a composite key contains the description, so a rename shows up as an insert plus an archive
+        updates = set() if self.segment.composite_key else (dartmouth_keys & planon_keys) - reactivates
+
+        archives = planon_keys - dartmouth_keys - archived_keys
+
+        return inserts, updates, archives, reactivates
+
+    # ********************* INSERTS ********************* #
+
+    def insert(self) -> List[Change]:
+        """Plans inserts of new records in Planon, if they don't exist"""
+
+        log.info(f"Total number of {self.segment.label} to be inserted in Planon {len(self.inserts)}")
+
+        changes = []
+
+        for insert in self.inserts:
+            audit.record(log, "planned", self.segment.segment_type, insert, f"Processing insert {insert}", operation=planon_utils.CREATE)
+
+            try:
+                dartmouth_record = self.dartmouth[insert]
+                changes.append(Change(planon_utils.CREATE, self.segment.segment_type, insert, dartmouth_record.code, dartmouth_record.description))
+
+            except Exception as e:
+                log.exception(e)
+                self.failed.append(insert)
+
+        return changes
+
+    # ********************* UPDATES ********************* #
+
+    def update(self) -> List[Change]:
+        """Plans updates of the name on the Planon side, if there is a change"""
+
+        log.info(f"Total number of {self.segment.label} to be updated in Planon {len(self.updates)}")
+
+        changes = []
+
+        for update in self.updates:
+            try:
+                dartmouth_record = self.dartmouth[update]
+                planon_record = self.planon[update]
+
+                if self.segment.values(dartmouth_record) != self.segment.planon_values(planon_record):
+                    audit.record(log, "planned", self.segment.segment_type, update, f"Processing update {update}", operation=planon_utils.SAVE)
+                    changes.append(Change(planon_utils.SAVE, self.segment.segment_type, update, planon_record.Code, dartmouth_record.description))
+
+            except Exception as e:
+                log.exception(e)
+                self.failed.append(update)
+
+        return changes
+
+    # ********************* ARCHIVES ********************* #
+
+    def archive(self) -> List[Change]:
+        """Plans archives of records in Planon, if they don't exist in Dartmouth"""
+
+        log.info(f"Total number of {self.segment.label} to be archived in Planon {len(self.archives)}")
+
+        changes = []
+
+        for archive in self.archives:
+            audit.record(log, "planned", self.segment.segment_type, archive, f"Processing archive {archive}", operation=planon_utils.ARCHIVE)
+
+            try:
+                planon_record = self.planon[archive]
+
+                log.debug(f"Archiving {planon_record.Name} with {planon_record.Code} ")
+                changes.append(Change(planon_utils.ARCHIVE, self.segment.segment_type, archive, planon_record.Code, planon_record.Name))
+
+            except Exception as e:
+                log.exception(e)
+                self.failed.append(archive)
+
+        return changes
+
+    # ********************* REACTIVATES ********************* #
+
+    def reactivate(self) -> List[Change]:
+        """Plans reactivations of archived records in Planon, if they are back in Dartmouth"""
+
+        log.info(f"Total number of {self.segment.label} to be reactivated in Planon {len(self.reactivates)}")
+
+        changes = []
+
+        for reactivate in self.reactivates:
+            audit.record(log, "planned", self.segment.segment_type, reactivate, f"Processing reactivate {reactivate}", operation=planon_utils.REACTIVATE)
+
+            try:
+                dartmouth_record = self.dartmouth[reactivate]
+                planon_record = self.planon[reactivate]
+
+                changes.append(Change(planon_utils.REACTIVATE, self.segment.segment_type, reactivate, planon_record.Code, dartmouth_record.description))
+
+            except Exception as e:
+                log.exception(e)
+                self.failed.append(reactivate)
+
+        return changes
+
+    # ********************* COLUMNAR ********************* #
+
+    def reconcile(self) -> List[Change]:
+        """Plans the same changes as the four phases above from one columnar join, see columnar.reconcile"""
+
+        dartmouth, planon = self.dartmouth, self.planon
+
+        if self.only is not None:
+            dartmouth = {key: dartmouth[key] for key in self.only if key in dartmouth}
+            planon = {key: planon[key] for key in self.only if key in planon}
+
+        planned = columnar.reconcile(self.segment, dartmouth, planon)
+
+        for operation, verb in ((planon_utils.CREATE, "inserted"), (planon_utils.SAVE, "updated"), (planon_utils.ARCHIVE, "archived"), (planon_utils.REACTIVATE, "reactivated")):
+            log.info(f"Total number of {self.segment.label} to be {verb} in Planon {len(planned[operation])}")
+
+        return [Change(operation, self.segment.segment_type, key, code, name) for operation, rows in planned.items() for key, code, name in rows]
+
+    def plan(self) -> List[Change]:
+        """Returns the inserts, updates, archives and reactivations for the segment, without touching Planon
+
+        Large segments are reconciled columnar when pandas is installed, see columnar.DIFF_ENGINE.
+        """
+
+        log.info(f"# **************** Processing COA {self.segment.label} **************** #")
+
+        rows = len(self.dartmouth) + len(self.planon)
+
+        with metrics.timer("plan", self.segment.name) as timing:
+            if columnar.use_columnar(rows):
+                with metrics.timer("diff", self.segment.name, records=rows):
+                    changes = self.reconcile()
+
+            else:
+                with metrics.timer("diff", self.segment.name, records=rows):
+                    self.inserts, self.updates, self.archives, self.reactivates = self.diff()
+
+                changes = self.insert() + self.update() + self.archive() + self.reactivate()
+
+            timing.records = len(changes)
+
+        return changes
+
+    def stale(self, change: Change) -> Optional[str]:
+        """Returns why Planon already has the change, None when it still needs it"""
+
+        planon_record = self.planon.get(change.key)
+
+        if planon_record is None:
+            return None
+
+        if change.operation == planon_utils.CREATE:
+            return "the key already exists in Planon"
+
+        if change.operation == planon_utils.SAVE and planon_record.Name == change.name:
+            return "the name already matches"
+
+        if change.operation == planon_utils.ARCHIVE and planon_record.IsArchived != False:
+            return "already archived"
+
+        if change.operation == planon_utils.REACTIVATE and planon_record.IsArchived == False:
+            return "already active"
+
+        return None
+
+    def apply(self, changes: Iterable[Change]) -> Tuple[List[Any], List[Any], List[Any]]:
+        """Queues the changes on the batch and sends them to Planon
+
+        Saves and archives look their record up in self.planon, so a saved
+        changeset can be applied against a fresh Planon read; a change that
+        read already has (see stale) is skipped, so applying a changeset
+        twice doesn't create duplicates.
+
+        Returns:
+            _type_: (succeeded, failed, archived)
+        """
+
+        changes = list(changes)
+
+        for change in changes:
+            try:
+                reason = self.stale(change)
+
+                if reason is not None:
+                    audit.record(log, "stale", self.segment.segment_type, change.key, f"Skipping stale {change.operation} {change.key}, {reason}", operation=change.operation)
+                    continue
+
+                if change.operation == planon_utils.CREATE:
+                    self.batch.create(change.key, values=self.segment.values(COARecord(change.code, change.name)))
+
+                elif change.operation == planon_utils.SAVE:
+                    planon_record = self.planon[change.key]
+                    planon_record.Name = change.name
+                    self.batch.save(change.key, planon_record)
+
+                elif change.operation == planon_utils.ARCHIVE:
+                    self.batch.archive(change.key, self.planon[change.key])
+
+                elif change.operation == planon_utils.REACTIVATE:
+                    self.batch.reactivate(change.key, self.planon[change.key], name=change.name)
+
+            except Exception as e:
+                log.exception(e)
+                self.failed.append(change.key)
+
+        log.info(f"Sending {len(self.batch)} {self.segment.label} changes to Planon")
+
+        with metrics.timer("apply", self.segment.name, records=len(changes)):
+            succeeded, failed, archived = self.batch.flush()
+
+        return succeeded, self.failed + failed, archived
+
+    def run(self) -> Tuple[List[Any], List[Any], List[Any]]:
+        """Plans the four phases and sends the writes
+
+        Returns:
+            _type_: (succeeded, failed, archived)
+        """
+
+        return self.apply(self.plan())
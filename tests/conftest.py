@@ -0,0 +1,31 @@
+import importlib.util
+import os
+import sys
+import types
+
+# the modules live at the repository root, next to main.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+# libplanon-rest is only called by the Planon reads and writes, which the tests don't make
+try:
+    import planon  # noqa: F401
+except ImportError:
+    planon = types.ModuleType("planon")
+    planon.PlanonResource = types.SimpleNamespace()
+    planon.UsrBillingAccounts = types.SimpleNamespace()
+
+    sys.modules["planon"] = planon
+
+# ipaas.utils is this checkout's utils.py, whatever ipaas is installed, like benchmark.repo_ipaas_module
+ipaas = types.ModuleType("ipaas")
+ipaas.__path__ = []
+
+spec = importlib.util.spec_from_file_location("ipaas.utils", os.path.join(ROOT, "utils.py"))
+ipaas.utils = importlib.util.module_from_spec(spec)
+
+sys.modules["ipaas"] = ipaas
+sys.modules["ipaas.utils"] = ipaas.utils
+
+spec.loader.exec_module(ipaas.utils)
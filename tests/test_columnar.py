@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pandas")
+
+import columnar
+import planon_utils
+from sync import SEGMENTS, COARecord, SegmentSync
+
+ENTITIES = SEGMENTS[0]
+SUBACTIVITIES = SEGMENTS[4]
+
+
+def billing_account(segment, code, name, archived=False):
+    return SimpleNamespace(Code=code, Name=name, SegmentType=segment.segment_type, IsArchived=archived)
+
+
+def entities():
+    dartmouth = {
+        "100": COARecord("100", "New entity"),
+        "200": COARecord("200", "Renamed entity"),
+        "300": COARecord("300", "Unchanged entity"),
+        "400": COARecord("400", "Entity back in Dartmouth"),
+    }
+    planon = {
+        "200": billing_account(ENTITIES, "200", "Old name"),
+        "300": billing_account(ENTITIES, "300", "Unchanged entity"),
+        "400": billing_account(ENTITIES, "400", "Old name", archived=True),
+        "500": billing_account(ENTITIES, "500", "Removed entity"),
+        "600": billing_account(ENTITIES, "600", "Archived history", archived=True),
+    }
+
+    return ENTITIES, dartmouth, planon
+
+
+def subactivities():
+    dartmouth = {
+        ("10", "Kept"): COARecord("10", "Kept"),
+        ("10", "Second description"): COARecord("10", "Second description"),
+        ("20", "Back in Dartmouth"): COARecord("20", "Back in Dartmouth"),
+    }
+    planon = {
+        ("10", "Kept"): billing_account(SUBACTIVITIES, "10", "Kept"),
+        ("10", "Old description"): billing_account(SUBACTIVITIES, "10", "Old description"),
+        ("20", "Back in Dartmouth"): billing_account(SUBACTIVITIES, "20", "Back in Dartmouth", archived=True),
+        ("30", "Archived history"): billing_account(SUBACTIVITIES, "30", "Archived history", archived=True),
+    }
+
+    return SUBACTIVITIES, dartmouth, planon
+
+
+def per_record(segment, dartmouth, planon, only=None):
+    segment_sync = SegmentSync(segment=segment, dartmouth=dartmouth, planon=planon, only=only)
+    segment_sync.inserts, segment_sync.updates, segment_sync.archives, segment_sync.reactivates = segment_sync.diff()
+
+    return set(segment_sync.insert() + segment_sync.update() + segment_sync.archive() + segment_sync.reactivate())
+
+
+def reconciled(segment, dartmouth, planon, only=None):
+    return set(SegmentSync(segment=segment, dartmouth=dartmouth, planon=planon, only=only).reconcile())
+
+
+@pytest.mark.parametrize("fixture", [entities, subactivities])
+def test_reconcile_plans_the_same_changes_as_the_four_phases(fixture):
+    segment, dartmouth, planon = fixture()
+
+    changes = reconciled(segment, dartmouth, planon)
+
+    assert changes == per_record(segment, dartmouth, planon)
+    assert {change.operation for change in changes} >= {planon_utils.CREATE, planon_utils.ARCHIVE, planon_utils.REACTIVATE}
+
+
+def test_reconcile_plans_renames_of_simple_keys_as_saves():
+    changes = reconciled(*entities())
+
+    assert [(change.key, change.name) for change in changes if change.operation == planon_utils.SAVE] == [("200", "Renamed entity")]
+
+
+@pytest.mark.parametrize("fixture, only", [(entities, {"100", "400", "500"}), (subactivities, {("10", "Old description"), ("20", "Back in Dartmouth")})])
+def test_reconcile_with_only_plans_the_same_changes_as_the_four_phases(fixture, only):
+    segment, dartmouth, planon = fixture()
+
+    assert reconciled(segment, dartmouth, planon, only) == per_record(segment, dartmouth, planon, only)
+
+
+def test_small_segments_do_not_import_pandas(monkeypatch):
+    monkeypatch.setattr(columnar, "pandas", None)
+    monkeypatch.setattr(columnar, "numpy", None)
+
+    assert not columnar.use_columnar(columnar.COLUMNAR_MIN_ROWS - 1)
+    assert columnar.pandas is None
@@ -0,0 +1,62 @@
+from journal import Journal
+
+# planon_utils.CREATE / SAVE, the journal itself doesn't need the planon client
+CREATE = "create"
+SAVE = "save"
+
+
+def interrupted_run(path: str) -> Journal:
+    journal = Journal(path=str(path))
+
+    journal.planned(CREATE, "SEG1", "1000", "1000", "Entity 1000")
+    journal.completed(CREATE, "SEG1", "1000", "1000", "Entity 1000")
+    journal.planned(SAVE, "SEG1", "1001", "1001", "Entity 1001")
+    journal.completed(SAVE, "SEG1", "1001", "1001", "Entity 1001")
+    journal.planned(SAVE, "SEG1", "1002", "1002", "Entity 1002")
+
+    return journal
+
+
+def test_resume_skips_done_operations_of_an_interrupted_run(tmp_path):
+    interrupted_run(tmp_path / "journal.jsonl").close()
+
+    resumed = Journal(path=str(tmp_path / "journal.jsonl"), resume=True)
+
+    assert resumed.is_done(CREATE, "SEG1", "1000", "1000", "Entity 1000")
+    assert resumed.is_done(SAVE, "SEG1", "1001", "1001", "Entity 1001")
+    assert not resumed.is_done(SAVE, "SEG1", "1002", "1002", "Entity 1002")
+
+
+def test_resume_sends_a_change_with_another_name(tmp_path):
+    interrupted_run(tmp_path / "journal.jsonl").close()
+
+    resumed = Journal(path=str(tmp_path / "journal.jsonl"), resume=True)
+
+    # Dartmouth renamed the record after the interrupted run saved it
+    assert not resumed.is_done(SAVE, "SEG1", "1001", "1001", "Entity 1001 renamed")
+
+
+def test_resume_after_a_finished_run_skips_nothing(tmp_path):
+    journal = interrupted_run(tmp_path / "journal.jsonl")
+    journal.finish()
+    journal.close()
+
+    resumed = Journal(path=str(tmp_path / "journal.jsonl"), resume=True)
+
+    assert not resumed.is_done(CREATE, "SEG1", "1000", "1000", "Entity 1000")
+    assert not resumed.is_done(SAVE, "SEG1", "1001", "1001", "Entity 1001")
+
+
+def test_resume_after_a_resumed_run_died_again(tmp_path):
+    journal = interrupted_run(tmp_path / "journal.jsonl")
+    journal.finish()
+    journal.close()
+
+    journal = Journal(path=str(tmp_path / "journal.jsonl"), resume=True)
+    journal.completed(SAVE, "SEG1", "1002", "1002", "Entity 1002")
+    journal.close()
+
+    resumed = Journal(path=str(tmp_path / "journal.jsonl"), resume=True)
+
+    assert resumed.is_done(SAVE, "SEG1", "1002", "1002", "Entity 1002")
+    assert not resumed.is_done(CREATE, "SEG1", "1000", "1000", "Entity 1000")
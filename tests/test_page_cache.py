@@ -0,0 +1,59 @@
+import hashlib
+import json
+from types import SimpleNamespace
+
+import ipaas.utils as utils
+
+
+class StubSession:
+    """general_ledger stub with an ETag per page, answers If-None-Match with a 304"""
+
+    def __init__(self, records: int):
+        self.records = records
+        self.not_modified = 0
+
+    def get(self, url: str, headers: dict, params: dict):
+        page, page_size = params.get("page", 1), params["pagesize"]
+        body = json.dumps([{"id": index} for index in range((page - 1) * page_size, min(page * page_size, self.records))]).encode("utf-8")
+        etag = hashlib.sha1(body).hexdigest()
+
+        if headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+
+            return SimpleNamespace(status_code=304, ok=False, content=b"", headers={"x-request-id": "request"})
+
+        return SimpleNamespace(status_code=200, ok=True, content=body, headers={"ETag": etag, "x-request-id": "request"})
+
+
+def fetch(session: StubSession, cache: utils.PageCache) -> int:
+    records = utils.iter_coa_segment("subactivities", base_url="https://api.example", session=session, page_size=10, jwt="jwt", prefetch=0, cache=cache, page_sizer=None)
+
+    return len(list(records))
+
+
+def test_fresh_cache_is_served_as_is(tmp_path):
+    cache = utils.PageCache(str(tmp_path))
+    session = StubSession(25)
+
+    assert fetch(session, cache) == 25
+
+    session.records = 40
+
+    assert fetch(session, cache) == 25
+
+
+def test_revalidated_first_page_refetches_the_rest(tmp_path):
+    # page 1 is past its TTL on every run and comes back unchanged
+    cache = utils.PageCache(str(tmp_path), ttl=0)
+    session = StubSession(25)
+
+    assert fetch(session, cache) == 25
+
+    session.records = 40
+
+    assert fetch(session, cache) == 40
+
+    session.records = 15
+
+    assert fetch(session, cache) == 15
+    assert session.not_modified == 2
@@ -1,13 +1,38 @@
+import asyncio
+import fcntl
+import hashlib
+import json
 import logging
 import math
 import os
-from typing import Any, Dict, List, Optional, Union
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
 
 from typing_extensions import Literal
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
+try:
+    import aiohttp
+except ImportError:  # optional, only the async_* functions need it
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:  # optional, a faster decoder for the general_ledger pages
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # optional, used when orjson isn't installed
+    msgspec = None
+
 # *********************************************************************
 # LOGGING - set of log messages
 # *********************************************************************
@@ -19,26 +44,379 @@ log = logging.getLogger(__name__)
 # retry session , if error
 # *********************************************************************
 
-PAGE_SIZE = 1000
+# records per general_ledger page, keep it within what the API accepts
+PAGE_SIZE = int(os.environ.get("COA_PAGE_SIZE", 1000))
+
+# pages requested ahead of the one being parsed, 0 keeps the original serial paging
+PREFETCH = int(os.environ.get("COA_PREFETCH", 0))
+
+# the general_ledger API fills every page but the last, so a short page needs no empty probe after it
+STOP_ON_SHORT_PAGE = os.environ.get("COA_STOP_ON_SHORT_PAGE", "false").lower() == "true"
+
+# delta mode: last-update field on the general_ledger resources and the query parameter filtering on it,
+# set COA_DELTA_PARAM empty when the API can't filter, records are then filtered locally
+# (watermarks are compared as strings, which orders ISO 8601 timestamps correctly)
+# the watermark record itself is fetched again: a record updated later in the same timestamp tick
+# would be missed by a strict comparison, and sending an unchanged record again is a no-op
+DELTA_FIELD = os.environ.get("COA_DELTA_FIELD", "last_update_date")
+DELTA_PARAM = os.environ.get("COA_DELTA_PARAM", "last_update_date_gte") or None
 
-DARTMOUTH_API_URL = os.environ["DARTMOUTH_API_URL"]
-DARTMOUTH_API_KEY = os.environ["DARTMOUTH_API_KEY"]
+SEGMENTS = ("entities", "orgs", "fundings", "activities", "subactivities", "natural_classes")
+
+# one worker per segment
+MAX_WORKERS = len(SEGMENTS)
+
+# read without failing, so the module imports without the iPaaS settings (tests, tooling);
+# the functions raise when they actually need them
+DARTMOUTH_API_URL = os.environ.get("DARTMOUTH_API_URL")
+DARTMOUTH_API_KEY = os.environ.get("DARTMOUTH_API_KEY")
+
+# a cached jwt is refreshed this many seconds before it expires, or after JWT_TTL when the payload has no exp
+JWT_REFRESH_MARGIN = int(os.environ.get("DARTMOUTH_JWT_REFRESH_MARGIN", 60))
+JWT_TTL = int(os.environ.get("DARTMOUTH_JWT_TTL", 900))
 
 log.debug(f"{DARTMOUTH_API_URL}")
 
 headers = {"Authorization": DARTMOUTH_API_KEY}
 
-session = requests.Session()
-session.headers["Accept"] = "application/json"
-
 MAX_RETRY = 5
 BACK_OFF_FACTOR = 1
 ERROR_CODES = (429, 500, 502, 503)
 
-### Retry mechanism for server error ### https://stackoverflow.com/questions/23267409/how-to-implement-retry-mechanism-into-python-requests-library###
-# {backoff factor} * (2 ** ({number of total retries} - 1))
-retry_strategy = Retry(total=MAX_RETRY, backoff_factor=BACK_OFF_FACTOR, status_forcelist=ERROR_CODES)
-session.mount("https://", HTTPAdapter(max_retries=retry_strategy))
+# statuses whose Retry-After header wins over the backoff, as urllib3's Retry.RETRY_AFTER_STATUS_CODES
+RETRY_AFTER_CODES = (429, 503)
+
+# connection pools kept (one per host) and connections kept per pool, sized for
+# MAX_WORKERS segments each with PREFETCH pages in flight so none is thrown away
+POOL_CONNECTIONS = int(os.environ.get("COA_POOL_CONNECTIONS", 10))
+POOL_MAXSIZE = int(os.environ.get("COA_POOL_MAXSIZE", max(10, MAX_WORKERS * (PREFETCH + 1))))
+
+# seconds to connect and to wait for data, applied to every request without its own timeout
+CONNECT_TIMEOUT = float(os.environ.get("COA_CONNECT_TIMEOUT", 10))
+READ_TIMEOUT = float(os.environ.get("COA_READ_TIMEOUT", 120))
+
+# opt-in on-disk cache of general_ledger pages, off unless COA_CACHE_DIR is set; a cached fetch is used
+# as is for COA_CACHE_TTL seconds, then its first page is revalidated with If-None-Match when the API
+# sent an ETag, the other pages are only kept with the first page they were fetched with and are
+# fetched again once it is past the TTL
+CACHE_DIR = os.environ.get("COA_CACHE_DIR")
+CACHE_TTL = int(os.environ.get("COA_CACHE_TTL", 3600))
+CACHE_MAX_BYTES = int(os.environ.get("COA_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# requests in flight across every segment and page on the async client
+ASYNC_CONCURRENCY = int(os.environ.get("COA_ASYNC_CONCURRENCY", 12))
+
+# opt-in adaptive page size: pages are halved when slow, too big or retried and doubled when well within
+# the target, between PAGE_SIZE_MIN and PAGE_SIZE_MAX; the size that worked is kept per segment in
+# PAGE_SIZE_STATE and used as the starting size of the next run
+ADAPTIVE_PAGE_SIZE = os.environ.get("COA_ADAPTIVE_PAGE_SIZE", "false").lower() == "true"
+PAGE_SIZE_MIN = int(os.environ.get("COA_PAGE_SIZE_MIN", 100))
+PAGE_SIZE_MAX = int(os.environ.get("COA_PAGE_SIZE_MAX", 10000))
+PAGE_TARGET_SECONDS = float(os.environ.get("COA_PAGE_TARGET_SECONDS", 2.0))
+PAGE_MAX_BYTES = int(os.environ.get("COA_PAGE_MAX_BYTES", 8 * 1024 * 1024))
+PAGE_SIZE_STATE = os.environ.get("COA_PAGE_SIZE_STATE", "coa_page_sizes.json")
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout, requests itself has none"""
+
+    def __init__(self, *args, timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+
+        return super().send(request, **kwargs)
+
+
+def create_session(
+    pool_connections: int = POOL_CONNECTIONS,
+    pool_maxsize: int = POOL_MAXSIZE,
+    max_retry: int = MAX_RETRY,
+    back_off_factor: float = BACK_OFF_FACTOR,
+    error_codes: Sequence[int] = ERROR_CODES,
+    timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+    compress: bool = True,
+) -> requests.Session:
+    """Returns a requests session set up for the iPaaS APIs
+
+    Args:
+        pool_connections (int), pool_maxsize (int): HTTPAdapter pool sizing
+        max_retry (int), back_off_factor (float), error_codes (tuple): Retry policy,
+            a Retry-After header on a 429 or 503 is honoured over the backoff
+        timeout (tuple): (connect, read) seconds for requests that don't pass one
+        compress (bool): ask for gzip/deflate encoded responses
+
+    Returns:
+        _type_: requests.Session
+    """
+
+    session = requests.Session()
+    session.headers["Accept"] = "application/json"
+
+    if compress:
+        session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    ### Retry mechanism for server error ### https://stackoverflow.com/questions/23267409/how-to-implement-retry-mechanism-into-python-requests-library###
+    # {backoff factor} * (2 ** ({number of total retries} - 1))
+    retry_strategy = Retry(total=max_retry, backoff_factor=back_off_factor, status_forcelist=error_codes, respect_retry_after_header=True)
+
+    adapter = TimeoutHTTPAdapter(max_retries=retry_strategy, pool_connections=pool_connections, pool_maxsize=pool_maxsize, timeout=timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+session = create_session()
+
+
+class PageCache:
+    """On-disk cache of general_ledger pages, one directory per fetch of a segment
+
+    The pages of a segment are cached as one unit: page 1 (the request
+    without a page parameter) starts a generation, and every later page is
+    stored with it and only served while page 1 still has the same one.
+    Page 1 has the TTL and is revalidated with If-None-Match; once it is
+    past the TTL every other page of that fetch is dropped, even on a 304,
+    since an unchanged page 1 says nothing about records added or removed
+    further on. Pages of two fetches are never mixed and a record that
+    moved across a page boundary in between isn't skipped.
+
+    The continuation_key is left out of the key, it changes every run; the
+    x-request-id of a cached first page is kept and reused instead, so keep
+    the TTL below the lifetime of a continuation key. Least recently used
+    pages are evicted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory: str, ttl: int = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def group(self, url: str, params: dict) -> str:
+        """Returns the directory of the fetch a page belongs to, the same for all of its pages"""
+
+        key = json.dumps([url, sorted((name, str(value)) for name, value in params.items() if name not in ("page", "continuation_key"))])
+
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def load(self, path: str) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        try:
+            with open(f"{path}.meta", "r") as meta_file, open(f"{path}.body", "rb") as body_file:
+                return json.load(meta_file), body_file.read()
+
+        except (OSError, ValueError):
+            return None
+
+    def store(self, path: str, meta: Dict[str, Any], body: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write then rename, prefetch threads may store pages at the same time
+        for suffix, mode, content in ((".body", "wb", body), (".meta", "w", json.dumps(meta))):
+            # forked shard workers share the parent's thread ids, the pid tells them apart
+            temporary = f"{path}{suffix}.{os.getpid()}.{threading.get_ident()}"
+
+            with open(temporary, mode) as cache_file:
+                cache_file.write(content)
+
+            os.replace(temporary, f"{path}{suffix}")
+
+        self.evict()
+
+    def drop(self, group: str):
+        """Removes every cached page of a fetch"""
+
+        with self.lock:
+            shutil.rmtree(group, ignore_errors=True)
+
+    def evict(self):
+        with self.lock:
+            entries = [entry for group in os.scandir(self.directory) if group.is_dir() for entry in os.scandir(group.path) if entry.name.endswith(".body")]
+            total = sum(entry.stat().st_size for entry in entries)
+
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                if total <= self.max_bytes:
+                    break
+
+                total -= entry.stat().st_size
+
+                for suffix in (".body", ".meta"):
+                    try:
+                        os.remove(entry.path[: -len(".body")] + suffix)
+                    except OSError:
+                        pass
+
+    def get(self, session: requests.Session, url: str, headers: dict, params: dict) -> Tuple[bytes, Optional[str]]:
+        """Returns the page body and its x-request-id, from the cache when fresh
+
+        Returns:
+            _type_: (bytes, str)
+        """
+
+        group = self.group(url, params)
+        page = params.get("page", 1)
+
+        if page == 1:
+            return self.get_first(session, url, headers, params, group)
+
+        first = self.load(os.path.join(group, "page-1"))
+        generation = first[0].get("generation") if first is not None else None
+
+        if generation is None:
+            # page 1 of this fetch was evicted, or the page size changed mid-fetch: nothing to tie the page to
+            response = session.get(url=url, headers=headers, params=params)
+
+            return response.content, response.headers.get("x-request-id")
+
+        path = os.path.join(group, f"page-{page}")
+        cached = self.load(path)
+
+        if cached is not None and cached[0].get("generation") == generation:
+            log.debug(f"Cache hit for {url} {page}")
+            os.utime(f"{path}.body")
+
+            meta, body = cached
+
+            return body, meta.get("request_id")
+
+        response = session.get(url=url, headers=headers, params=params)
+
+        if response.ok:
+            self.store(path, {"generation": generation, "request_id": response.headers.get("x-request-id")}, response.content)
+
+        return response.content, response.headers.get("x-request-id")
+
+    def get_first(self, session: requests.Session, url: str, headers: dict, params: dict, group: str) -> Tuple[bytes, Optional[str]]:
+        """Returns page 1, a fresh copy of it starts a new generation of the fetch"""
+
+        path = os.path.join(group, "page-1")
+        cached = self.load(path)
+
+        if cached is not None:
+            meta, body = cached
+
+            if time.time() - meta["stored_at"] < self.ttl:
+                log.debug(f"Cache hit for {url} 1")
+                os.utime(f"{path}.body")
+
+                return body, meta.get("request_id")
+
+            if meta.get("etag"):
+                headers = dict(headers, **{"If-None-Match": meta["etag"]})
+
+        response = session.get(url=url, headers=headers, params=params)
+
+        # the later pages are refetched either way, a 304 only saves page 1's body
+        self.drop(group)
+
+        if response.status_code == 304 and cached is not None:
+            log.debug(f"Cache revalidated for {url} 1")
+
+            content, etag = body, meta.get("etag")
+        elif response.ok:
+            content, etag = response.content, response.headers.get("ETag")
+        else:
+            return response.content, response.headers.get("x-request-id")
+
+        stored_at = time.time()
+        request_id = response.headers.get("x-request-id", meta.get("request_id") if cached is not None else None)
+
+        meta = {"stored_at": stored_at, "etag": etag, "request_id": request_id, "generation": f"{request_id}@{stored_at}"}
+        self.store(path, meta, content)
+
+        return content, request_id
+
+
+page_cache = PageCache(CACHE_DIR) if CACHE_DIR else None
+
+
+class PageSizer:
+    """Picks the general_ledger page size per segment from how the previous pages went
+
+    Pages are addressed by number, so iter_coa_segment only switches size at
+    an offset the new size divides; the size is remembered per segment in a
+    JSON file for the next run. A segment that fitted in one page without a
+    slow page is remembered at its record count (plus headroom), so with
+    COA_STOP_ON_SHORT_PAGE it is read in a single request next time.
+    """
+
+    def __init__(
+        self,
+        path: str = PAGE_SIZE_STATE,
+        minimum: int = PAGE_SIZE_MIN,
+        maximum: int = PAGE_SIZE_MAX,
+        target_seconds: float = PAGE_TARGET_SECONDS,
+        max_bytes: int = PAGE_MAX_BYTES,
+    ):
+        self.path = path
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.sizes: Dict[str, int] = self.load()
+
+    def load(self) -> Dict[str, int]:
+        try:
+            with open(self.path, "r") as state_file:
+                return json.load(state_file)
+
+        except (OSError, ValueError):
+            return {}
+
+    def clamp(self, page_size: int) -> int:
+        return min(max(int(page_size), self.minimum), self.maximum)
+
+    def initial(self, segment: str, page_size: int) -> int:
+        """returns the remembered size of the segment, page_size when there is none"""
+
+        return self.clamp(self.sizes.get(segment, page_size))
+
+    def next_size(self, page_size: int, seconds: float, content_bytes: int, records: int, retries: int = 0) -> int:
+        """returns the size for the next page, given how the last one went"""
+
+        if retries or seconds > self.target_seconds or content_bytes > self.max_bytes:
+            return self.clamp(page_size // 2)
+
+        # only a full page says anything about a bigger one
+        if records >= page_size and seconds * 2 <= self.target_seconds and content_bytes * 2 <= self.max_bytes:
+            return self.clamp(page_size * 2)
+
+        return page_size
+
+    def remember(self, segment: str, page_size: int, records: int, slowed: bool = False):
+        """keeps the size for the next run of the segment, written straight to the state file"""
+
+        # a segment that took several pages keeps the size it was read with, a larger one was never tried
+        if not slowed and records <= page_size:
+            # room for the segment to grow a little before it needs a second page again
+            page_size = max(page_size, math.ceil(records * 1.1 / 100) * 100)
+
+        # the thread lock covers this process, the file lock the shard worker processes writing the same file
+        with self.lock, open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            # re-read first, another worker may have remembered its segment since
+            self.sizes = dict(self.load(), **{segment: self.clamp(page_size)})
+
+            temporary = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+
+            with open(temporary, "w") as state_file:
+                json.dump(self.sizes, state_file, indent=2, sort_keys=True)
+
+            os.replace(temporary, self.path)
+
+        log.debug(f"Remembered page size {self.sizes[segment]} for {segment}")
+
+
+page_sizer = PageSizer() if ADAPTIVE_PAGE_SIZE else None
 
 # *********************************************************************
 # FUNCTIONS -
@@ -51,17 +429,23 @@ session.mount("https://", HTTPAdapter(max_retries=retry_strategy))
 # *********************************************************************
 
 
-def get_jwt(session: requests.Session = session, base_url: str = DARTMOUTH_API_URL, key: str = DARTMOUTH_API_KEY, scopes: str = "") -> str:
-    """Returns a jwt for authentication to the iPaaS APIs
+def request_jwt(session: requests.Session = session, base_url: Optional[str] = None, key: Optional[str] = None, scopes: str = "") -> Dict[str, Any]:
+    """Returns the iPaaS /api/jwt response, with the jwt and its payload
 
     Args:
         url (str): LOGIN_URL= https://api.dartmouth.edu/api/jwt
         key (str): API_KEY
 
     Returns:
-        _type_: str
+        _type_: dict
     """
 
+    base_url = base_url or DARTMOUTH_API_URL
+    key = key or DARTMOUTH_API_KEY
+
+    if not base_url or not key:
+        raise Exception("DARTMOUTH_API_URL and DARTMOUTH_API_KEY are required to obtain a jwt")
+
     headers = {"Authorization": key}
 
     url = f"{base_url}/api/jwt"
@@ -77,29 +461,118 @@ def get_jwt(session: requests.Session = session, base_url: str = DARTMOUTH_API_U
         if scopes and scopes not in response_json["accepted_scopes"]:
             raise Exception(f"Scope {scopes} not in the list of accepted scopes")
 
-        jwt = response_json["jwt"]
-
     else:
         raise Exception("Failed to obtain a jwt")
 
-    return jwt
+    return response_json
 
 
-def get_coa_segment(
-    segment: Literal["entities", "orgs", "fundings", "activities", "subactivities", "natural_classes"],
-    base_url: str = DARTMOUTH_API_URL,
-    session: requests.Session = session,
-    page_size=PAGE_SIZE,
-    jwt: str = get_jwt(),
-) -> List[Dict[str, Any]]:
-    """returns iPaaS resources
+def get_jwt(session: requests.Session = session, base_url: Optional[str] = None, key: Optional[str] = None, scopes: str = "") -> str:
+    """Returns a jwt for authentication to the iPaaS APIs
+
     Args:
-        jwt (str): Dartmouth JSON web token
-        url (str): https://api.dartmouth.edu/general_ledger/***segment***
+        url (str): LOGIN_URL= https://api.dartmouth.edu/api/jwt
+        key (str): API_KEY
+
     Returns:
-        _type_: list[dict], list[]
+        _type_: str
+    """
+
+    return request_jwt(session=session, base_url=base_url, key=key, scopes=scopes)["jwt"]
+
+
+# *********************************************************************
+# CLASSES -
+# JWTProvider: fetch the jwt on first use, cache it until shortly before
+# the exp in its payload and share it between threads
+# *********************************************************************
+
+
+class JWTProvider:
+    """Lazily obtained, cached and refreshed iPaaS jwt, safe to share between threads"""
+
+    def __init__(
+        self,
+        session: requests.Session = session,
+        base_url: Optional[str] = None,
+        key: Optional[str] = None,
+        scopes: str = "",
+        refresh_margin: int = JWT_REFRESH_MARGIN,
+    ):
+        self.session = session
+        self.base_url = base_url
+        self.key = key
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+
+        self.jwt: Optional[str] = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def get(self) -> str:
+        """Returns the cached jwt, obtaining a new one when it is missing or about to expire"""
+
+        with self.lock:
+            if self.jwt is None or time.time() >= self.expires_at - self.refresh_margin:
+                response_json = request_jwt(session=self.session, base_url=self.base_url, key=self.key, scopes=self.scopes)
+
+                payload = response_json.get("payload") or {}
+
+                self.jwt = response_json["jwt"]
+                self.expires_at = float(payload["exp"]) if "exp" in payload else time.time() + JWT_TTL
+
+                log.debug(f"Obtained a jwt expiring at {self.expires_at}")
+
+            return self.jwt
+
+
+# shared by every call that isn't given a jwt explicitly
+jwt_provider = JWTProvider()
+
+# called after every general_ledger request with (segment, seconds, records, retries),
+# e.g. main.py collects its run metrics through it; cache hits report 0 retries
+request_hooks: List[Callable[[str, float, int, int], None]] = []
+
+
+def observe_request(segment: str, seconds: float, records: int, retries: int = 0):
+    for hook in request_hooks:
+        hook(segment, seconds, records, retries)
+
+
+def count_retries(response: requests.Response) -> int:
+    """returns how many times urllib3 retried the request behind response"""
+
+    retries = getattr(response.raw, "retries", None)
+
+    return len(retries.history) if retries is not None else 0
+
+
+def decode_json(content: bytes) -> Any:
+    """decodes a json body with orjson or msgspec when installed, the standard library otherwise
+    Returns:
+        _type_: Any
     """
 
+    if orjson is not None:
+        return orjson.loads(content)
+
+    if msgspec is not None:
+        return msgspec.json.decode(content)
+
+    return json.loads(content)
+
+
+def get_segment_url(segment: str, base_url: Optional[str] = None) -> str:
+    """returns the general_ledger url for a segment
+    Returns:
+        _type_: str
+    """
+
+    base_url = base_url or DARTMOUTH_API_URL
+
+    if not base_url:
+        raise Exception("DARTMOUTH_API_URL is required to get chart of accounts segments")
+
     url = f"{base_url}/api/general_ledger/{segment}"
 
     # *********************************************************************
@@ -110,35 +583,497 @@ def get_coa_segment(
     if segment in ["entities", "orgs", "fundings", "activities", "natural_classes"]:
         url = f"{url}?parent_child_flag=C"
 
-    headers: dict = {"Authorization": "Bearer " + jwt, "Content-Type": "application/json"}
+    return url
 
-    coa_segment = []
 
-    response = session.get(url=url, headers=headers, params={"pagesize": page_size})
-    response_json = response.json()
+def select_changed(records: List[Dict[str, Any]], changed_since: Optional[str] = None, delta_field: str = DELTA_FIELD) -> List[Dict[str, Any]]:
+    """returns the records whose delta_field is at or after changed_since, all of them without a watermark
+    Returns:
+        _type_: list[dict]
+    """
 
-    coa_segment += response_json
+    if changed_since is None:
+        return records
 
-    continuation_key = response.headers.get("x-request-id")
+    # records without the field can't be ruled out, keep them
+    return [record for record in records if record.get(delta_field) is None or str(record[delta_field]) >= changed_since]
 
-    page = 2
 
-    # use for loop until last page:
-    while response_json:
+def iter_coa_segment(
+    segment: Literal["entities", "orgs", "fundings", "activities", "subactivities", "natural_classes"],
+    base_url: Optional[str] = None,
+    session: requests.Session = session,
+    page_size=PAGE_SIZE,
+    jwt: Optional[str] = None,
+    prefetch: int = PREFETCH,
+    stop_on_short_page: bool = STOP_ON_SHORT_PAGE,
+    changed_since: Optional[str] = None,
+    delta_field: str = DELTA_FIELD,
+    delta_param: Optional[str] = DELTA_PARAM,
+    cache: Optional[PageCache] = page_cache,
+    page_sizer: Optional[PageSizer] = page_sizer,
+) -> Iterator[Dict[str, Any]]:
+    """yields iPaaS resources as each page arrives, only one page is held at a time
+    Args:
+        jwt (str): Dartmouth JSON web token, by default taken from jwt_provider per request,
+            so a long paging run picks up a refreshed token
+        url (str): https://api.dartmouth.edu/general_ledger/***segment***
+        prefetch (int): pages kept in flight after the first one, 0 pages serially
+        stop_on_short_page (bool): treat a page shorter than page_size as the last one,
+            only safe when the server always fills every page but the last
+        changed_since (str): watermark, only records whose delta_field is at or after it are yielded;
+            sent as delta_param when set and always applied locally as well, so an API
+            that ignores the parameter still gives the right result
+        cache (PageCache): pages are read through it when given, see COA_CACHE_DIR
+        page_sizer (PageSizer): when given, page_size is only the starting size of a segment
+            it has no size for yet, and serial paging resizes between pages, see COA_ADAPTIVE_PAGE_SIZE
+    Yields:
+        _type_: dict
+    """
+
+    url = get_segment_url(segment=segment, base_url=base_url)
+
+    if page_sizer is not None:
+        page_size = page_sizer.initial(segment, page_size)
+
+    # how the last page went, for page_sizer
+    last_page: Dict[str, Any] = {}
+    slowed = False
+
+    def get_headers() -> dict:
+        return {"Authorization": "Bearer " + (jwt or jwt_provider.get()), "Content-Type": "application/json"}
+
+    delta_params: dict = {}
+
+    if changed_since is not None and delta_param:
+        delta_params[delta_param] = changed_since
+
+    def select(response_json: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return select_changed(response_json, changed_since=changed_since, delta_field=delta_field)
+
+    def get_content(params: dict) -> Tuple[bytes, Optional[str], int]:
+        if cache is not None:
+            return (*cache.get(session, url, get_headers(), params), 0)
+
+        response = session.get(url=url, headers=get_headers(), params=params)
+
+        return response.content, response.headers.get("x-request-id"), count_retries(response)
+
+    def get_json(params: dict) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        start = time.perf_counter()
+
+        content, request_id, retries = get_content(params)
+        response_json = decode_json(content)
+
+        seconds = time.perf_counter() - start
+
+        observe_request(segment, seconds, len(response_json), retries)
+
+        last_page.update(seconds=seconds, content_bytes=len(content), records=len(response_json), retries=retries, page_size=params["pagesize"])
+
+        return response_json, request_id
+
+    def resize() -> int:
+        """returns the size page_sizer wants after the last page"""
+
+        nonlocal slowed
+
+        new_size = page_sizer.next_size(**last_page)
+
+        if new_size < last_page["page_size"]:
+            slowed = True
+
+        return new_size
+
+    records = 0
+
+    response_json, continuation_key = get_json({"pagesize": page_size, **delta_params})
+
+    records += len(response_json)
+    yield from select(response_json)
+
+    def get_page(page: int) -> List[Dict[str, Any]]:
         log.debug(f"Starting with page number {page}")
 
-        response = session.get(url=url, headers=headers, params={"pagesize": page_size, "page": page, "continuation_key": continuation_key})
+        response_json, _ = get_json({"pagesize": page_size, "page": page, "continuation_key": continuation_key, **delta_params})
 
-        response_json = response.json()
+        return response_json
 
-        log.debug(f"Response contained {len(response_json)} records")
+    def is_last_page(response_json: List[Dict[str, Any]]) -> bool:
+        return not response_json or (stop_on_short_page and len(response_json) < page_size)
 
-        coa_segment += response_json
+    page = 2
 
-        log.debug(f"Records returned, so far: {len(coa_segment)}")
-        page += 1
+    if is_last_page(response_json):
+        log.debug(f"Ending on page {page - 1}")
+
+    elif prefetch > 0:
+        # *********************************************************************
+        # Pipelined: keep `prefetch` pages in flight, consume them in order and
+        # drop whatever is still outstanding once the last page is seen
+        # *********************************************************************
+
+        with ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix=f"coa-{segment}") as executor:
+            in_flight = deque(executor.submit(get_page, page + offset) for offset in range(prefetch))
+            next_page = page + prefetch
+
+            while in_flight:
+                response_json = in_flight.popleft().result()
+
+                log.debug(f"Response contained {len(response_json)} records")
+
+                records += len(response_json)
+                yield from select(response_json)
+
+                log.debug(f"Records returned, so far: {records}")
+                page += 1
+
+                if is_last_page(response_json):
+                    for future in in_flight:
+                        future.cancel()
+                    break
+
+                in_flight.append(executor.submit(get_page, next_page))
+                next_page += 1
+
+        log.debug(f"Ending on page {page}")
 
     else:
+        # use for loop until last page:
+        while True:
+            if page_sizer is not None:
+                new_size = resize()
+
+                # page n of size s starts at record (n - 1) * s, so the size can only change where the new one divides the offset
+                if new_size != page_size and records % new_size == 0:
+                    log.debug(f"Page size for {segment} {page_size} -> {new_size}")
+
+                    page_size = new_size
+                    page = records // page_size + 1
+
+            response_json = get_page(page)
+
+            log.debug(f"Response contained {len(response_json)} records")
+
+            records += len(response_json)
+            yield from select(response_json)
+
+            log.debug(f"Records returned, so far: {records}")
+            page += 1
+
+            if is_last_page(response_json):
+                break
+
         log.debug(f"Ending on page {page}")
 
+    if page_sizer is not None:
+        resize()
+        page_sizer.remember(segment, page_size, records, slowed=slowed)
+
+
+def get_coa_segment(
+    segment: Literal["entities", "orgs", "fundings", "activities", "subactivities", "natural_classes"],
+    **kwargs,
+) -> List[Dict[str, Any]]:
+    """returns iPaaS resources
+    Args:
+        segment (str): general_ledger segment name
+        kwargs: passed on to iter_coa_segment
+    Returns:
+        _type_: list[dict], list[]
+    """
+
+    return list(iter_coa_segment(segment=segment, **kwargs))
+
+
+def get_coa_segment_dict(
+    segment: Literal["entities", "orgs", "fundings", "activities", "subactivities", "natural_classes"],
+    key: Callable[[Dict[str, Any]], Hashable],
+    value: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    **kwargs,
+) -> Dict[Hashable, Any]:
+    """returns iPaaS resources keyed by `key`, built straight from iter_coa_segment
+    Args:
+        key (callable): returns the dict key for a record, later records win on duplicates
+        value (callable): optional, turns the record into what is stored, e.g. a compact
+            record holding only the fields the sync reads, so the decoded dict can be freed
+        kwargs: passed on to iter_coa_segment
+    Returns:
+        _type_: dict[key, dict] or dict[key, value(dict)]
+    """
+
+    if value is None:
+        return {key(record): record for record in iter_coa_segment(segment=segment, **kwargs)}
+
+    return {key(record): value(record) for record in iter_coa_segment(segment=segment, **kwargs)}
+
+
+def get_coa_segments(
+    segments: Sequence[str] = SEGMENTS,
+    base_url: Optional[str] = None,
+    session: requests.Session = session,
+    page_size=PAGE_SIZE,
+    jwt: Optional[str] = None,
+    max_workers: int = MAX_WORKERS,
+    prefetch: int = PREFETCH,
+    stop_on_short_page: bool = STOP_ON_SHORT_PAGE,
+    keys: Optional[Dict[str, Callable[[Dict[str, Any]], Hashable]]] = None,
+    changed_since: Optional[Dict[str, str]] = None,
+    values: Optional[Dict[str, Callable[[Dict[str, Any]], Any]]] = None,
+) -> Dict[str, Any]:
+    """returns iPaaS resources for several segments, fetched concurrently
+    Args:
+        segments (list): segment names, as accepted by get_coa_segment
+        keys (dict): optional key function per segment, the segment is then
+            streamed into a keyed dict (get_coa_segment_dict) instead of a list
+        changed_since (dict): optional delta watermark per segment, see iter_coa_segment
+        max_workers (int): upper bound on segments being paged at the same time
+        jwt (str): Dartmouth JSON web token, defaults to the shared jwt_provider
+        prefetch (int), stop_on_short_page (bool): passed on to get_coa_segment
+    Returns:
+        _type_: dict[str, list[dict]] or dict[str, dict[key, dict]], keyed by segment
+    """
+
+    # requests.Session is shared between the workers, the mounted HTTPAdapter
+    # (and its Retry policy) is applied per request, so retries keep working
+    kwargs: dict = {"base_url": base_url, "session": session, "page_size": page_size, "jwt": jwt, "prefetch": prefetch, "stop_on_short_page": stop_on_short_page}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="coa-segment") as executor:
+        futures = {}
+
+        for segment in segments:
+            segment_kwargs = dict(kwargs, changed_since=(changed_since or {}).get(segment))
+
+            if keys is None:
+                futures[segment] = executor.submit(get_coa_segment, segment=segment, **segment_kwargs)
+            else:
+                futures[segment] = executor.submit(get_coa_segment_dict, segment=segment, key=keys[segment], value=(values or {}).get(segment), **segment_kwargs)
+
+        # result() re-raises, a failed segment fails the whole fetch as it did when serial
+        coa_segments = {segment: future.result() for segment, future in futures.items()}
+
+    for segment, coa_segment in coa_segments.items():
+        log.debug(f"Retrieved {len(coa_segment)} {segment}")
+
+    return coa_segments
+
+
+def latest_change(records: Iterable[Dict[str, Any]], delta_field: str = DELTA_FIELD) -> Optional[str]:
+    """returns the latest delta_field value among records, the next delta watermark
+    Returns:
+        _type_: str or None when no record carries the field
+    """
+
+    return max((str(record[delta_field]) for record in records if record.get(delta_field) is not None), default=None)
+
+
+# *********************************************************************
+# ASYNC - aiohttp client for the general_ledger API
+# one event loop, one keep-alive connection pool and one semaphore bound
+# every segment and page; retries follow MAX_RETRY / BACK_OFF_FACTOR /
+# ERROR_CODES like the requests session, also on connection errors and
+# timeouts, honouring Retry-After on a 429 or 503
+# *********************************************************************
+
+
+async def async_get_json(
+    client: "aiohttp.ClientSession", semaphore: asyncio.Semaphore, url: str, headers: dict, params: dict, segment: str = ""
+) -> Tuple[List[Dict[str, Any]], Mapping[str, str]]:
+    """returns the decoded json and the headers of a GET, retried on ERROR_CODES, connection errors and timeouts
+    Args:
+        segment (str): reported to request_hooks
+    Returns:
+        _type_: (list[dict], headers)
+    """
+
+    # aiohttp doesn't reliably merge params into a query string already on the url
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = {**dict(parse_qsl(query)), **{name: str(value) for name, value in params.items() if value is not None}}
+    url = urlunsplit((scheme, netloc, path, "", fragment))
+
+    start = time.perf_counter()
+
+    for attempt in range(1, MAX_RETRY + 2):
+        status: Optional[int] = None
+        retry_after = ""
+
+        try:
+            async with semaphore:
+                async with client.get(url, headers=headers, params=params) as response:
+                    if response.status not in ERROR_CODES or attempt > MAX_RETRY:
+                        response.raise_for_status()
+                        response_json = decode_json(await response.read())
+
+                        observe_request(segment, time.perf_counter() - start, len(response_json), attempt - 1)
+
+                        return response_json, response.headers
+
+                    status = response.status
+                    retry_after = response.headers.get("Retry-After", "")
+
+        except aiohttp.ClientResponseError:
+            # raise_for_status on a status that isn't retried
+            raise
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # like Retry(total=MAX_RETRY), connection errors and timeouts count against the same retries
+            if attempt > MAX_RETRY:
+                raise
+
+            reason = repr(e)
+
+        else:
+            reason = str(status)
+
+        # {backoff factor} * (2 ** ({number of total retries} - 1))
+        delay = float(retry_after) if status in RETRY_AFTER_CODES and retry_after.isdigit() else BACK_OFF_FACTOR * (2 ** (attempt - 1))
+
+        log.debug(f"{reason} from {url}, retry {attempt} in {delay}s")
+        await asyncio.sleep(delay)
+
+    raise Exception(f"Retries exhausted for {url}")
+
+
+async def async_get_coa_segment(
+    segment: Literal["entities", "orgs", "fundings", "activities", "subactivities", "natural_classes"],
+    client: "aiohttp.ClientSession",
+    semaphore: asyncio.Semaphore,
+    base_url: Optional[str] = None,
+    page_size=PAGE_SIZE,
+    jwt: Optional[str] = None,
+    prefetch: int = PREFETCH,
+    stop_on_short_page: bool = STOP_ON_SHORT_PAGE,
+    changed_since: Optional[str] = None,
+    delta_field: str = DELTA_FIELD,
+    delta_param: Optional[str] = DELTA_PARAM,
+    key: Optional[Callable[[Dict[str, Any]], Hashable]] = None,
+    value: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    page_sizer: Optional[PageSizer] = page_sizer,
+) -> Any:
+    """returns iPaaS resources, the async counterpart of get_coa_segment / get_coa_segment_dict
+    Args:
+        client (aiohttp.ClientSession): shared client, keeps the connections alive
+        semaphore (asyncio.Semaphore): shared bound on requests in flight
+        prefetch (int): pages in flight after the first one, at least one
+        key (callable): when given, records are collected into a dict keyed by it
+        value (callable): optional, what is stored per key, see get_coa_segment_dict
+        page_sizer (PageSizer): when given, the segment starts at its remembered size;
+            the pages are all in flight at once, so the size isn't changed here
+    Returns:
+        _type_: list[dict] or dict[key, dict]
+    """
+
+    url = get_segment_url(segment=segment, base_url=base_url)
+
+    if page_sizer is not None:
+        page_size = page_sizer.initial(segment, page_size)
+
+    async def get_headers() -> dict:
+        return {"Authorization": "Bearer " + (jwt or await asyncio.to_thread(jwt_provider.get)), "Content-Type": "application/json"}
+
+    delta_params: dict = {delta_param: changed_since} if changed_since is not None and delta_param else {}
+
+    coa_segment: Any = {} if key else []
+
+    def collect(response_json: List[Dict[str, Any]]):
+        selected = select_changed(response_json, changed_since=changed_since, delta_field=delta_field)
+
+        if key:
+            coa_segment.update((key(record), value(record) if value else record) for record in selected)
+        else:
+            coa_segment.extend(selected)
+
+    def is_last_page(response_json: List[Dict[str, Any]]) -> bool:
+        return not response_json or (stop_on_short_page and len(response_json) < page_size)
+
+    response_json, response_headers = await async_get_json(client, semaphore, url, await get_headers(), {"pagesize": page_size, **delta_params}, segment)
+    collect(response_json)
+
+    continuation_key = response_headers.get("x-request-id")
+
+    async def get_page(page: int) -> List[Dict[str, Any]]:
+        log.debug(f"Starting with page number {page}")
+
+        params = {"pagesize": page_size, "page": page, "continuation_key": continuation_key, **delta_params}
+        response_json, _ = await async_get_json(client, semaphore, url, await get_headers(), params, segment)
+
+        return response_json
+
+    page = 2
+
+    if not is_last_page(response_json):
+        in_flight = deque(asyncio.ensure_future(get_page(page + offset)) for offset in range(max(prefetch, 1)))
+        next_page = page + len(in_flight)
+
+        try:
+            while in_flight:
+                response_json = await in_flight.popleft()
+
+                log.debug(f"Response contained {len(response_json)} records")
+
+                collect(response_json)
+                page += 1
+
+                if is_last_page(response_json):
+                    break
+
+                in_flight.append(asyncio.ensure_future(get_page(next_page)))
+                next_page += 1
+
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    log.debug(f"Ending {segment} on page {page} with {len(coa_segment)} records")
+
     return coa_segment
+
+
+async def async_get_coa_segments(
+    segments: Sequence[str] = SEGMENTS,
+    base_url: Optional[str] = None,
+    page_size=PAGE_SIZE,
+    jwt: Optional[str] = None,
+    prefetch: int = PREFETCH,
+    stop_on_short_page: bool = STOP_ON_SHORT_PAGE,
+    keys: Optional[Dict[str, Callable[[Dict[str, Any]], Hashable]]] = None,
+    changed_since: Optional[Dict[str, str]] = None,
+    values: Optional[Dict[str, Callable[[Dict[str, Any]], Any]]] = None,
+    max_concurrency: int = ASYNC_CONCURRENCY,
+) -> Dict[str, Any]:
+    """returns iPaaS resources for several segments on one event loop, the async counterpart of get_coa_segments
+    Args:
+        max_concurrency (int): requests in flight across all segments and pages, also the connection pool size
+    Returns:
+        _type_: dict[str, list[dict]] or dict[str, dict[key, dict]], keyed by segment
+    """
+
+    if aiohttp is None:
+        raise Exception("aiohttp is required for the async general_ledger client")
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+
+    # aiohttp asks for and decodes gzip/deflate by default
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers={"Accept": "application/json"}) as client:
+        coa_segments = await asyncio.gather(
+            *(
+                async_get_coa_segment(
+                    segment=segment,
+                    client=client,
+                    semaphore=semaphore,
+                    base_url=base_url,
+                    page_size=page_size,
+                    jwt=jwt,
+                    prefetch=prefetch,
+                    stop_on_short_page=stop_on_short_page,
+                    changed_since=(changed_since or {}).get(segment),
+                    key=(keys or {}).get(segment),
+                    value=(values or {}).get(segment),
+                )
+                for segment in segments
+            )
+        )
+
+    return dict(zip(segments, coa_segments))